@@ -0,0 +1,591 @@
+"""Offline benchmark of the bot: drives the real conversation handler with synthetic updates.
+
+Nothing leaves the process, the Bot API is answered by FakeRequest, so the numbers only cover
+the bot itself: handlers, the task store, serialization of the Bot API calls.
+
+    python benchmark.py                                 # users and tasks from 1 to 100k
+    python benchmark.py --scales 1,1000 --flows 100
+    python benchmark.py --save baseline.json
+    python benchmark.py --baseline baseline.json        # exits with 1 on a regression
+    python benchmark.py --replay updates.log            # updates recorded with UPDATE_LOG
+    python benchmark.py --axes planner                  # plan updates on random task sets
+    python benchmark.py --axes eventlog --scales 10000000   # recovery from a log of 10M task events
+    python benchmark.py --axes startup --scales 0,100000 --flows 10   # cold starts, up to the first reply
+    python benchmark.py --axes routing --flows 100000   # task buttons routed by regexes and by the router
+    python benchmark.py --axes persistence --scales 10000   # handler latency without persistence, with sqlite and file
+    python benchmark.py --axes memory --scales 1000000 --flows 10000   # bytes per task and user, 1M tasks of 10k users
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import count
+from queue import Queue
+from threading import Event, Thread
+
+from telegram import Update
+from telegram.ext import CallbackQueryHandler, Dispatcher, ExtBot, JobQueue, TypeHandler, Updater
+
+import eatthefrogbot as bot
+import eventlog
+from persistence import FilePersistence, SQLitePersistence
+from metrics import TimedRequest
+from routing import CallbackRouter, decode, encode
+from tasks import Task, TaskStore, NEW, IN_PROGRESS, DONE, STATES
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'TakeTheFrogBot', 'username': 'TakeTheFrogBot'}
+FLOW_TASK_NAME = 'benchmark'
+
+
+class FakeRequest(TimedRequest):
+    """Answers every Bot API call locally, remembering the last keyboard sent to each chat."""
+
+    __slots__ = ('keyboards', '_message_ids')
+
+    def __init__(self):
+        super().__init__()
+        self.keyboards = {}
+        self._message_ids = count(1)
+
+    def _request_wrapper(self, method, url, *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        data = json.loads(kwargs.get('body') or '{}')
+        if endpoint == 'getMe':
+            result = BOT_USER
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            chat_id = int(data.get('chat_id', 0))
+            if 'reply_markup' in data:
+                self.keyboards[chat_id] = json.loads(data['reply_markup'])['inline_keyboard']
+            result = {'message_id': next(self._message_ids), 'date': int(time.time()), 'from': BOT_USER,
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': data.get('text', '')}
+        else:
+            result = True
+        return json.dumps({'ok': True, 'result': result}).encode()
+
+    def buttons(self, chat_id):
+        return [button['callback_data'] for row in self.keyboards.get(chat_id, ()) for button in row]
+
+
+def message_update(update_id, user_id, text):
+    message = {'message_id': 0, 'date': int(time.time()), 'text': text,
+               'chat': {'id': user_id, 'type': 'private'},
+               'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': update_id, 'message': message}
+
+
+def press_update(update_id, user_id, callback_data):
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'chat_instance': str(user_id), 'data': callback_data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'},
+        'message': {'message_id': 0, 'date': int(time.time()), 'text': '', 'from': BOT_USER,
+                    'chat': {'id': user_id, 'type': 'private'}},
+    }}
+
+
+class Bench:
+    """A dispatcher with the conversation handler of the bot, timing every update it processes."""
+
+    def __init__(self, persistence=None):
+        self.request = FakeRequest()
+        self.bot = ExtBot('123:benchmark', request=self.request)
+        self.dispatcher = Dispatcher(self.bot, Queue(), workers=0, job_queue=JobQueue(), persistence=persistence)
+        self.conversation = bot.build_conversation_handler(persistent=persistence is not None)
+        self.dispatcher.add_handler(self.conversation)
+        self.latencies = defaultdict(list)
+        self._update_ids = count(1)
+
+    def process(self, data):
+        update = Update.de_json(data, self.bot)
+        key = (update.effective_chat.id, update.effective_user.id) if update.effective_user else None
+        state = self.conversation.conversations.get(key) or 'START'
+        started = time.perf_counter()
+        self.dispatcher.process_update(update)
+        self.latencies[state].append(time.perf_counter() - started)
+
+    def message(self, user_id, text):
+        self.process(message_update(next(self._update_ids), user_id, text))
+
+    def press(self, user_id, callback_data):
+        self.process(press_update(next(self._update_ids), user_id, callback_data))
+
+    def preload(self, users, tasks_per_user):
+        """Give users tasks directly, without going through the handlers."""
+        deadline = time.time() + 2 * 24 * 3600
+        for user_id in range(1, users + 1):
+            tasks = bot.get_tasks(self.dispatcher.user_data[user_id])
+            for i in range(tasks_per_user):
+                tasks.add(Task(bot.task_ids.next_id(), 'task {}'.format(i), 1, deadline + i, NEW))
+
+    def flow(self, user_id):
+        """Add a task, then start, extend, finish and delete it, and go back to the main menu."""
+        if self.conversation.conversations.get((user_id, user_id)) is None:
+            self.message(user_id, '/start')
+        deadline = (datetime.now() + timedelta(days=1)).replace(microsecond=0)
+        self.press(user_id, bot.TASKS_MENU)
+        self.press(user_id, bot.ADD_NEW_TASK)
+        self.message(user_id, FLOW_TASK_NAME)
+        self.message(user_id, '2')
+        self.message(user_id, deadline.isoformat(' '))
+        self.press(user_id, bot.GET_TASK)
+        # The new task has the closest deadline, so it is the first one listed
+        task_button = self.request.buttons(user_id)[0]
+        task_id = decode(task_button)[1]
+        self.press(user_id, task_button)
+        self.press(user_id, encode(bot.OP_START, task_id))
+        self.press(user_id, task_button)
+        self.press(user_id, encode(bot.OP_EXTEND, task_id))
+        self.press(user_id, encode(bot.OP_FINISH, task_id))
+        self.press(user_id, encode(bot.OP_DELETE, task_id))
+        self.press(user_id, bot.BACK_TO_TASK_CHOICE)
+        self.press(user_id, bot.BACK_TO_TASK_MENU)
+        self.press(user_id, bot.ALL_TASKS)
+        self.press(user_id, bot.BACK_TO_TASK_MENU)
+        self.press(user_id, bot.END)
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summarize(latencies, elapsed, **extra):
+    updates = sum(len(values) for values in latencies.values())
+    states = {}
+    for state, values in sorted(latencies.items()):
+        values.sort()
+        states[state] = {'count': len(values), 'p50_ms': percentile(values, 0.5) * 1000,
+                         'p99_ms': percentile(values, 0.99) * 1000, 'max_ms': values[-1] * 1000}
+    return dict(extra, updates=updates, updates_per_sec=updates / elapsed if elapsed else 0, states=states)
+
+
+def run_scale(axis, scale, flows):
+    bench = Bench()
+    users, tasks_per_user = (scale, 1) if axis == 'users' else (1, scale)
+
+    gc.collect()
+    tracemalloc.start()
+    bench.preload(users, tasks_per_user)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for i in range(flows):
+        bench.flow(i % users + 1)
+    elapsed = time.perf_counter() - started
+    return summarize(bench.latencies, elapsed, axis=axis, scale=scale, memory_mb=memory / 2 ** 20)
+
+
+PERSISTENCE_BACKENDS = {'none': None, 'sqlite': SQLitePersistence, 'file': FilePersistence}
+
+
+def flush_every(persistence, interval, stop):
+    while not stop.wait(interval):
+        persistence.flush()
+
+
+def run_persistence(scale, flows):
+    """Time task flows of scale users with a task each, without persistence and with every backend.
+
+    The backends start with all the users stored and are flushed every second from a thread, as by
+    the flush job of the bot.
+    """
+    latencies = defaultdict(list)
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        for name, backend in PERSISTENCE_BACKENDS.items():
+            persistence = backend and backend(os.path.join(directory, name))
+            bench = Bench(persistence)
+            bench.preload(scale, 1)
+            stop = Event()
+            if persistence is not None:
+                for user_id, data in bench.dispatcher.user_data.items():
+                    persistence.update_user_data(user_id, data)
+                persistence.flush()
+                flusher = Thread(target=flush_every, args=(persistence, 1, stop))
+                flusher.start()
+            for i in range(flows):
+                bench.flow(i % scale + 1)
+            if persistence is not None:
+                stop.set()
+                flusher.join()
+                persistence.flush()
+            latencies[name] = [value for values in bench.latencies.values() for value in values]
+    elapsed = time.perf_counter() - started
+
+    result = summarize(latencies, elapsed, axis='persistence', scale=scale, memory_mb=0)
+    # Throughput is of the flows with a backend
+    stored = latencies['sqlite'] + latencies['file']
+    result.update(updates=len(stored), updates_per_sec=len(stored) / sum(stored))
+    return result
+
+
+class BaselineTask:
+    """The task record before slots and epoch seconds, for the memory axis."""
+
+    def __init__(self, id, name, duration, time_left, deadline, state):
+        self.id = id
+        self.name = name
+        self.duration = duration
+        self.time_left = time_left
+        self.deadline = deadline
+        self.state = state
+
+
+def build_baseline(rng, now, scale, users):
+    """scale tasks of users as they were stored: a list of plain tasks with datetimes in every user's data."""
+    user_data = defaultdict(dict)
+    for i in range(scale):
+        tasks = user_data[rng.randrange(users)].setdefault('TASKS', [])
+        state = rng.choice(STATES)
+        deadline = datetime.fromtimestamp(now + rng.uniform(3600, 90 * 24 * 3600))
+        time_left = deadline - timedelta(hours=1) if state == IN_PROGRESS else None
+        tasks.append(BaselineTask(i, 'task {}'.format(i), rng.randint(1, 8), time_left, deadline, state))
+    return user_data
+
+
+def build_records(rng, now, scale, users):
+    """The tasks of build_baseline as slotted tasks in epoch seconds, still in a list per user."""
+    user_data = defaultdict(dict)
+    for i in range(scale):
+        tasks = user_data[rng.randrange(users)].setdefault('TASKS', [])
+        state = rng.choice(STATES)
+        deadline = now + rng.uniform(3600, 90 * 24 * 3600)
+        task = Task(bot.task_ids.next_id(), 'task {}'.format(i), rng.randint(1, 8), deadline, state)
+        if state == IN_PROGRESS:
+            task.started_at, task.ends_at = now, deadline - 3600
+        tasks.append(task)
+    return user_data
+
+
+def build_stores(rng, now, scale, users):
+    """The tasks of build_records in the TaskStore of every user, with its indexes and plan."""
+    user_data = build_records(rng, now, scale, users)
+    for data in user_data.values():
+        tasks = data['TASKS']
+        data['TASKS'] = TaskStore()
+        data['TASKS'].add_many(tasks)
+    return user_data
+
+
+def run_memory(scale, users):
+    """Memory of scale random tasks of users, stored as before the slotted tasks and as now.
+
+    records is the slotted tasks alone, after adds the indexes of the task stores.
+    """
+    now = time.time()
+    latencies = defaultdict(list)
+    sizes = {}
+    started = time.perf_counter()
+    for name, build in (('before', build_baseline), ('records', build_records), ('after', build_stores)):
+        gc.collect()
+        tracemalloc.start()
+        begin = time.perf_counter()
+        user_data = build(random.Random(scale), now, scale, users)
+        latencies[name].append(time.perf_counter() - begin)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        sizes[name] = {'per_task': memory / scale, 'per_user': memory / len(user_data), 'mb': memory / 2 ** 20}
+        del user_data
+    elapsed = time.perf_counter() - started
+
+    result = summarize(latencies, elapsed, axis='memory', scale=scale, memory_mb=sizes['after']['mb'], bytes=sizes)
+    # Throughput is of building the task stores
+    result.update(updates=scale, updates_per_sec=scale / latencies['after'][0])
+    return result
+
+
+def random_task(rng, now):
+    return Task(bot.task_ids.next_id(), 'task', rng.randint(1, 8), now + rng.uniform(3600, 90 * 24 * 3600), NEW)
+
+
+def run_planner(scale, operations):
+    """Time the plan of a user with scale random tasks through adding, starting, extending and finishing tasks.
+
+    Every operation is followed by the feasibility check the plan view makes.
+    """
+    rng = random.Random(scale)
+    now = time.time()
+    latencies = defaultdict(list)
+
+    gc.collect()
+    tracemalloc.start()
+    tasks = TaskStore()
+    tasks.add_many(random_task(rng, now) for _ in range(scale))
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    def timed(name, operation):
+        started = time.perf_counter()
+        operation()
+        tasks.first_late(now)
+        latencies[name].append(time.perf_counter() - started)
+
+    def start():
+        tasks.set_state(task, IN_PROGRESS)
+        task.started_at = now
+        task.ends_at = now + task.duration * 3600
+
+    def extend():
+        task.ends_at += task.duration * 3600
+        tasks.touch(task)
+
+    started = time.perf_counter()
+    for _ in range(operations):
+        task = random_task(rng, now)
+        timed('add', lambda: tasks.add(task))
+        timed('start', start)
+        timed('extend', extend)
+        timed('finish', lambda: tasks.set_state(task, DONE))
+        tasks.remove(task.id)
+    elapsed = time.perf_counter() - started
+    return summarize(latencies, elapsed, axis='planner', scale=scale, memory_mb=memory / 2 ** 20)
+
+
+def write_events(path, scale, users):
+    """Write a log of scale random task events of users to path."""
+    rng = random.Random(scale)
+    now = time.time()
+    live = defaultdict(list)
+    events = [eventlog.ADDED] * 4 + [eventlog.STARTED, eventlog.EXTENDED, eventlog.FINISHED, eventlog.DELETED]
+    # Written straight to a buffered file, the log itself flushes every event
+    with open(path, 'wb') as file:
+        for _ in range(scale):
+            user_id = rng.randrange(users)
+            tasks = live[user_id]
+            event = rng.choice(events) if tasks else eventlog.ADDED
+            if event == eventlog.ADDED:
+                task = random_task(rng, now)
+                tasks.append(task)
+            else:
+                task = tasks[rng.randrange(len(tasks))]
+            if event == eventlog.STARTED:
+                task.state, task.started_at, task.ends_at = IN_PROGRESS, now, now + task.duration * 3600
+            elif event == eventlog.EXTENDED:
+                task.ends_at = (task.ends_at or now) + task.duration * 3600
+            elif event == eventlog.FINISHED:
+                task.state = DONE
+            elif event == eventlog.DELETED:
+                tasks.remove(task)
+                file.write(eventlog.encode(event, user_id, task.id))
+                continue
+            file.write(eventlog.encode(event, user_id, task.id, task))
+
+
+def run_eventlog(scale, users):
+    """Time the recovery of the tasks of users from a log of scale random task events, then its compaction."""
+    latencies = defaultdict(list)
+
+    with tempfile.TemporaryDirectory() as directory:
+        log = eventlog.EventLog(os.path.join(directory, 'events'))
+        write_events(log.path, scale, users)
+        size = os.path.getsize(log.path)
+
+        gc.collect()
+        started = time.perf_counter()
+        stores = log.load()
+        elapsed = time.perf_counter() - started
+        latencies['load'].append(elapsed)
+        del stores
+
+        for name, operation in (('compact', log.compact), ('load_compacted', log.load)):
+            started = time.perf_counter()
+            operation()
+            latencies[name].append(time.perf_counter() - started)
+        log.close()
+
+    # Throughput is of the recovery, in events replayed per second
+    result = summarize(latencies, elapsed, axis='eventlog', scale=scale, memory_mb=size / 2 ** 20)
+    result.update(updates=scale, updates_per_sec=scale / elapsed)
+    return result
+
+
+# The task list state as it was routed before the compact callback_data: a regex per button,
+# tried in order, and handlers parsing the data again
+REGEX_ROUTES = [r'\d+', 'BACK_TO_TASK_CHOICE', r'TASK_PAGE_\d+', r'ALL_TASKS_PAGE_\w+_\d+', 'BACK_TO_TASK_MENU',
+                r'STARTED_TASK_\d+', r'FINISH_TASK_\d+', r'EXTEND_TASK_\d+', r'DELETE_TASK_\d+', 'SELECT_TASKS',
+                r'SELECT_TASK_\d+', r'BATCH_(FINISH_TASK|EXTEND_TASK|DELETE_TASK)', 'END']
+
+
+def callback_update(update_id, callback_data):
+    return Update.de_json({'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'chat_instance': '1', 'data': callback_data,
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'user'},
+    }}, None)
+
+
+def run_routing(scale, operations):
+    """Time routing operations task button presses among scale tasks, by regexes and by the router of the bot."""
+    rng = random.Random(scale)
+    task_ids = [bot.task_ids.next_id() for _ in range(scale)]
+    regex_ops = ['{}', 'STARTED_TASK_{}', 'FINISH_TASK_{}', 'EXTEND_TASK_{}', 'DELETE_TASK_{}', 'SELECT_TASK_{}']
+    router_ops = [bot.OP_OPEN, bot.OP_START, bot.OP_FINISH, bot.OP_EXTEND, bot.OP_DELETE, bot.OP_SELECT]
+    presses = [(rng.randrange(len(router_ops)), rng.choice(task_ids)) for _ in range(operations)]
+    regex_updates = [callback_update(i, regex_ops[op].format(task_id)) for i, (op, task_id) in enumerate(presses)]
+    router_updates = [callback_update(i, encode(router_ops[op], task_id)) for i, (op, task_id) in enumerate(presses)]
+
+    handlers = [CallbackQueryHandler(len, pattern='^' + pattern + '$') for pattern in REGEX_ROUTES]
+    router = CallbackRouter(dict(bot.BUTTONS[bot.ALL_TASKS]))
+    latencies = defaultdict(list)
+
+    def by_regex(update):
+        for handler in handlers:
+            if handler.check_update(update):
+                data = update.callback_query.data
+                return handler, int(data if data.isdigit() else data.rsplit('_', 1)[1])
+
+    started = time.perf_counter()
+    for regex_update, router_update in zip(regex_updates, router_updates):
+        begin = time.perf_counter()
+        by_regex(regex_update)
+        middle = time.perf_counter()
+        router.check_update(router_update)
+        latencies['router'].append(time.perf_counter() - middle)
+        latencies['regex'].append(middle - begin)
+    elapsed = time.perf_counter() - started
+
+    result = summarize(latencies, elapsed, axis='routing', scale=scale, memory_mb=0)
+    # Throughput is of the router alone
+    result.update(updates=operations, updates_per_sec=operations / sum(latencies['router']))
+    return result
+
+
+def cold_start(event_log):
+    """Child process of run_startup: start the bot offline the way main does and handle a first update.
+
+    Prints the startup phases as JSON, along with the wall clock time the imports started.
+    """
+    startup = bot.startup
+    startup.mark('imports')
+    logging.disable(logging.WARNING)
+    warnings.simplefilter('ignore')
+    updater = Updater(bot=ExtBot('123:benchmark', request=FakeRequest()), workers=0, use_context=True)
+    updater.dispatcher.add_handler(TypeHandler(Update, startup), group=-3)
+    startup.mark('updater')
+    bot.setup_dispatcher(updater, None, event_log or None)
+    startup.mark('handlers')
+    updater.dispatcher.process_update(Update.de_json(message_update(1, 1, '/start'), updater.bot))
+    startup.mark('first_reply')
+    started = time.time() - (time.perf_counter() - startup.started)
+    print(json.dumps(dict(startup.phases, started=started, finished=started + startup.elapsed)))
+
+
+def run_startup(scale, runs):
+    """Time runs cold starts of the bot in fresh processes, up to its reply to a first update.
+
+    With a scale, the tasks are recovered from an event log of scale events first.
+    """
+    latencies = defaultdict(list)
+    with tempfile.TemporaryDirectory() as directory:
+        path = ''
+        if scale:
+            path = os.path.join(directory, 'events')
+            write_events(path, scale, max(scale // 100, 1))
+        started = time.perf_counter()
+        for _ in range(runs):
+            launched = time.time()
+            # Imported first, so that the bot times the imports of telegram too
+            output = subprocess.run([sys.executable, '-c', 'import eatthefrogbot, benchmark, sys; '
+                                     'benchmark.cold_start(sys.argv[1])', path],
+                                    cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE,
+                                    check=True).stdout
+            phases = json.loads(output)
+            latencies['interpreter'].append(phases.pop('started') - launched)
+            latencies['time_to_first_reply'].append(phases.pop('finished') - launched)
+            for phase, seconds in phases.items():
+                latencies[phase].append(seconds)
+        elapsed = time.perf_counter() - started
+
+    # Peak resident memory of the biggest child, in kilobytes on Linux
+    memory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    result = summarize(latencies, elapsed, axis='startup', scale=scale, memory_mb=memory / 2 ** 20)
+    result.update(updates=runs, updates_per_sec=runs / elapsed)
+    return result
+
+
+def replay(filenames):
+    bench = Bench()
+    started = time.perf_counter()
+    for filename in filenames:
+        with open(filename) as file:
+            for line in file:
+                if line.strip():
+                    bench.process(json.loads(line))
+    return summarize(bench.latencies, time.perf_counter() - started, axis='replay', scale=len(filenames), memory_mb=0)
+
+
+def report(results):
+    for result in results:
+        print('{axis:>7} {scale:>7}: {updates_per_sec:9.1f} updates/s, {memory_mb:8.2f} MB preloaded'.format(**result))
+        for state, stats in result['states'].items():
+            print('        {:<22} {count:>6} updates  p50 {p50_ms:7.3f} ms  p99 {p99_ms:7.3f} ms  max {max_ms:7.3f} ms'
+                  .format(state, **stats))
+        for layout, sizes in result.get('bytes', {}).items():
+            print('        {:<22} {per_task:8.1f} bytes per task  {per_user:10.1f} bytes per user  {mb:8.2f} MB'
+                  .format(layout, **sizes))
+
+
+def regressions(results, baseline, tolerance):
+    expected = {(result['axis'], result['scale']): result['updates_per_sec'] for result in baseline}
+    failed = []
+    for result in results:
+        key = (result['axis'], result['scale'])
+        if key in expected and result['updates_per_sec'] < expected[key] * (1 - tolerance):
+            failed.append('{} {}: {:.1f} updates/s, baseline {:.1f}'.format(
+                key[0], key[1], result['updates_per_sec'], expected[key]))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', default='1,10,100,1000,10000,100000',
+                        help='comma separated numbers of users and of tasks per user')
+    parser.add_argument('--axes', default='users,tasks',
+                        help='users, tasks, planner, eventlog, startup, routing, persistence or memory')
+    parser.add_argument('--flows', type=int, default=200,
+                        help='task flows, planner operations, cold starts or button presses run at every scale, '
+                             'users of the event log and of the memory axis')
+    parser.add_argument('--replay', nargs='+', metavar='LOG', help='replay logs of recorded updates instead')
+    parser.add_argument('--save', metavar='FILE', help='write the results as JSON')
+    parser.add_argument('--baseline', metavar='FILE', help='fail if slower than these saved results')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    # Keep the output to the results, PTB warns about the setup of the conversation
+    logging.disable(logging.WARNING)
+    warnings.simplefilter('ignore')
+
+    if args.replay:
+        results = [replay(args.replay)]
+    else:
+        runs = {'planner': run_planner, 'eventlog': run_eventlog, 'startup': run_startup, 'routing': run_routing,
+                'persistence': run_persistence, 'memory': run_memory}
+        results = [runs[axis](int(scale), args.flows) if axis in runs else run_scale(axis, int(scale), args.flows)
+                   for axis in args.axes.split(',') for scale in args.scales.split(',')]
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            failed = regressions(results, json.load(file), args.tolerance)
+        for line in failed:
+            print('REGRESSION ' + line)
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import time
+from collections import OrderedDict
+
+from telegram.ext import DispatcherHandlerStop
+
+
+class CallbackDebouncer:
+    """Update callback dropping a button tap that repeats the previous update of its chat within window seconds.
+
+    Registered in a group before the conversation, so a double tap is only answered, to stop the
+    loading animation of the button, and never reaches the handlers. Runs on the dispatcher
+    thread, which handles one update at a time.
+    """
+
+    def __init__(self, window, answer):
+        self.window = window
+        self.answer = answer
+        self.counters = {'passed': 0, 'coalesced': 0}
+        self._last = OrderedDict()
+
+    def __call__(self, update, context):
+        if update.effective_chat is None:
+            return
+        chat_id = update.effective_chat.id
+        query = update.callback_query
+        if query is None:
+            # A message in between makes the next tap a new one
+            self._last.pop(chat_id, None)
+            return
+        now = time.monotonic()
+        last = self._last.get(chat_id)
+        if last is not None and last[0] == query.data and now - last[1] < self.window:
+            self.counters['coalesced'] += 1
+            self.answer(query)
+            raise DispatcherHandlerStop()
+
+        self.counters['passed'] += 1
+        self._last[chat_id] = (query.data, now)
+        self._last.move_to_end(chat_id)
+        # Entries are ordered by time, drop the ones that can't match anymore
+        while self._last:
+            oldest = next(iter(self._last.values()))
+            if now - oldest[1] < self.window:
+                break
+            self._last.popitem(last=False)
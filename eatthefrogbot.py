@@ -1,19 +1,40 @@
+import time
+
+# Startup phases are timed from the start of the imports
+IMPORT_STARTED = time.perf_counter()
+
+import csv
+import io
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-from dotenv import load_dotenv
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update, ParseMode
+from telegram.error import TelegramError
 from telegram.ext import (
     Updater,
     CommandHandler,
     MessageHandler,
     Filters,
     ConversationHandler,
-    CallbackQueryHandler,
     CallbackContext,
+    TypeHandler,
+    ExtBot,
 )
 
+from debounce import CallbackDebouncer
+from eventlog import ADDED, EXTENDED, FINISHED, STARTED, EventLog
+from ids import IdAllocator
+from importer import MAX_ERRORS, document_rows, parse_tasks, text_rows
+from metrics import TimedRequest, instrument, registry, start_server, tasks_per_user, timed_job
+from reminders import ReminderScheduler
+from render import RenderCache
+from routing import CallbackRouter, encode
+from sender import OutboundQueue
+from startup import StartupTimer
+from tasks import Task, TaskStore, NEW, IN_PROGRESS, DONE
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
 )
@@ -28,52 +49,139 @@ TYPING_TASK_NAME = 'TYPING_TASK_NAME'
 TYPING_TASK_DURATION = 'TYPING_TASK_DURATION'
 TYPING_TASK_DEADLINE = 'TYPING_TASK_DEADLINE'
 GET_TASK = 'GET_TASK'
-STARTED_TASK = 'STARTED_TASK'
 BACK_TO_TASK_CHOICE = 'BACK_TO_TASK_CHOICE'
 BACK_TO_TASK_MENU = 'BACK_TO_TASK_MENU'
 DELETE_TASK = 'DELETE_TASK'
-NEW = 'NEW'
-IN_PROGRESS = 'IN_PROGRESS'
-DONE = 'DONE'
 FINISH_TASK = 'FINISH_TASK'
 EXTEND_TASK = 'EXTEND_TASK'
 END = 'END'
 ADD_NEW_TASK = 'ADD_NEW_TASK'
+TASK_PAGE = 'TASK_PAGE'
+DRAFT = 'DRAFT'
+IMPORT_TASKS = 'IMPORT_TASKS'
+SHOW_PLAN = 'SHOW_PLAN'
+TYPING_IMPORT = 'TYPING_IMPORT'
+SELECT_TASKS = 'SELECT_TASKS'
+SELECTED_TASKS = 'SELECTED_TASKS'
+BATCH = 'BATCH'
+BATCH_ACTIONS = {FINISH_TASK: 'finished', EXTEND_TASK: 'extended', DELETE_TASK: 'deleted'}
+IMPORT_MAX_SIZE = 1024 * 1024
+ANSWER_THREADS = 8
+ANY_STATE = 'ANY'
+PAGE_SIZE = 10
+# A digest section lists this many tasks, names cut to DIGEST_NAME_LENGTH, keeping it within a message
+DIGEST_SECTION_LINES = 15
+DIGEST_NAME_LENGTH = 60
+CONVERSATION_NAME = 'eatthefrog'
+# Opcodes of the buttons carrying a task id or a page offset, encoded by routing.encode
+OP_OPEN = 'o'
+OP_START = 's'
+OP_FINISH = 'f'
+OP_EXTEND = 'e'
+OP_DELETE = 'd'
+OP_SELECT = 'x'
+OP_PAGE = 'p'
+ALL_TASKS_PAGE_OPS = {ANY_STATE: 'a', NEW: 'n', IN_PROGRESS: 'i', DONE: 'c'}
+ALL_TASKS_FILTERS = {opcode: state for state, opcode in ALL_TASKS_PAGE_OPS.items()}
+
+startup = StartupTimer(IMPORT_STARTED)
+task_ids = IdAllocator()
+reminders = ReminderScheduler()
+outbox = OutboundQueue()
+sent_digests = {}
+events = None
+answers = ThreadPoolExecutor(max_workers=ANSWER_THREADS, thread_name_prefix='answer')
+debouncer = CallbackDebouncer(window=1, answer=lambda query: answers.submit(answer_callback_query, query))
+render_cache = RenderCache()
+
+# Static menus are built once at import
+START_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(text='Tasks', callback_data=str(TASKS_MENU))],
+    [InlineKeyboardButton(text='What is procrastination?', callback_data=str(PROCRASTINATION))],
+    [InlineKeyboardButton(text='Done', callback_data=str(END))],
+])
+TASKS_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(text='Add new task', callback_data=str(ADD_NEW_TASK))],
+    [InlineKeyboardButton(text='Import tasks', callback_data=str(IMPORT_TASKS))],
+    [InlineKeyboardButton(text='My tasks', callback_data=str(GET_TASK))],
+    [InlineKeyboardButton(text='Show all tasks', callback_data=str(ALL_TASKS))],
+    [InlineKeyboardButton(text='Plan my tasks', callback_data=str(SHOW_PLAN))],
+    [InlineKeyboardButton(text='Back', callback_data=str(END))]
+])
+BACK_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton(text='Back', callback_data=str(END))]])
+DONE_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton(text='Done', callback_data=str(END))]])
+BACK_TO_TASK_CHOICE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(text='Back', callback_data=str(BACK_TO_TASK_CHOICE))]
+])
+BACK_TO_TASK_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(text='Back', callback_data=str(BACK_TO_TASK_MENU))]
+])
+DONE_TO_TASK_CHOICE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(text='Done', callback_data=str(BACK_TO_TASK_CHOICE))]
+])
+
+
+def format_time(timestamp):
+    return str(datetime.fromtimestamp(timestamp))
+
+
+def get_tasks(user_data) -> TaskStore:
+    if 'TASKS' not in user_data:
+        user_data['TASKS'] = TaskStore()
+    return user_data['TASKS']
+
+
+def answer_callback_query(query, text=None):
+    try:
+        query.answer(text=text)
+    except TelegramError as error:
+        logging.warning('Could not answer callback query %s: %s', query.id, error)
+
+
+def edit_message(update: Update, **kwargs) -> None:
+    """Edit the message of the pressed button, answering the callback query at the same time.
+
+    The answer only stops the loading animation of the button, so it is sent from the answers
+    pool while the message is edited and a tap costs a single round trip.
+    """
+    answers.submit(answer_callback_query, update.callback_query)
+    update.callback_query.edit_message_text(**kwargs)
 
-task_num = 0
 
+def still_busy(update: Update, context: CallbackContext) -> None:
+    """Answer an update of a chat whose previous update is still handled, which the conversation won't take.
 
-class Task:
-    def __init__(self, id, name, duration, time_left, deadline, state):
-        self.id = id
-        self.name = name
-        self.duration = duration
-        self.time_left = time_left
-        self.deadline = deadline
-        self.state = state
+    The conversation keeps its state, a tapped button stops loading and a typed message is asked again.
+    """
+    if update.callback_query is not None:
+        answers.submit(answer_callback_query, update.callback_query, 'Still working on your previous tap')
+    elif update.effective_chat is not None:
+        outbox.send_message(update.effective_chat.id,
+                            text='Still working on your previous message, please send this one again in a moment')
+
+
+def record_event(event, user_id, task):
+    if events is not None:
+        events.record(event, user_id, task)
+
+
+def task_not_found(update: Update, context: CallbackContext) -> None:
+    edit_message(update, text='This task doesn\'t exist anymore',
+                 reply_markup=BACK_TO_TASK_CHOICE_KEYBOARD)
+    context.user_data[START_OVER] = True
+
+    return ALL_TASKS
 
 
 def start(update: Update, context: CallbackContext) -> None:
     text = (
         'Choose, what do you want me to do? To abort, simply type /stop.'
     )
-    buttons = [
-        [
-            InlineKeyboardButton(text='Tasks', callback_data=str(TASKS_MENU)),
-        ],
-        [
-            InlineKeyboardButton(text='What is procrastination?', callback_data=str(PROCRASTINATION)),
-        ],
-        [
-            InlineKeyboardButton(text='Done', callback_data=str(END)),
-        ],
-    ]
-    keyboard = InlineKeyboardMarkup(buttons)
+    keyboard = START_KEYBOARD
 
     # If we're starting over we don't need do send a new message
     if context.user_data.get(START_OVER):
-        update.callback_query.answer()
-        update.callback_query.edit_message_text(text=text, reply_markup=keyboard)
+        edit_message(update, text=text, reply_markup=keyboard)
     else:
         update.message.reply_text(
             'Hi, I\'m TakeTheFrogBot! I can help you to overcome the procrastination.'
@@ -87,10 +195,8 @@ def start(update: Update, context: CallbackContext) -> None:
 
 def end(update: Update, context: CallbackContext) -> None:
     """End conversation from InlineKeyboardButton."""
-    update.callback_query.answer()
-
     text = 'See you around!'
-    update.callback_query.edit_message_text(text=text)
+    edit_message(update, text=text)
 
     return END
 
@@ -111,11 +217,7 @@ def show_procrastination(update: Update, context: CallbackContext) -> None:
            'this fierce enemy, you will be able to accomplish more and in doing so better utilize the potential that ' \
            'life has to offer. '
 
-    buttons = [[InlineKeyboardButton(text='Back', callback_data=str(END))]]
-    keyboard = InlineKeyboardMarkup(buttons)
-
-    update.callback_query.answer()
-    update.callback_query.edit_message_text(text=text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+    edit_message(update, text=text, reply_markup=BACK_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
     user_data[START_OVER] = True
 
     return PROCRASTINATION
@@ -123,19 +225,12 @@ def show_procrastination(update: Update, context: CallbackContext) -> None:
 
 def tasks_menu(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    buttons = [
-        [InlineKeyboardButton(text='Add new task', callback_data=str(ADD_NEW_TASK))],
-        [InlineKeyboardButton(text='My tasks', callback_data=str(GET_TASK))],
-        [InlineKeyboardButton(text='Show all tasks', callback_data=str(ALL_TASKS))],
-        [InlineKeyboardButton(text='Back', callback_data=str(END))]
-    ]
-    keyboard = InlineKeyboardMarkup(buttons)
+    keyboard = TASKS_MENU_KEYBOARD
 
     if not context.user_data.get(START_OVER):
-        update.callback_query.answer()
-        update.callback_query.edit_message_text(text='Choose an option about tasks', reply_markup=keyboard)
+        edit_message(update, text='Choose an option about tasks', reply_markup=keyboard)
     else:
-        number_of_tasks = len(user_data['TASKS'])
+        number_of_tasks = len(get_tasks(user_data))
         text = 'Got it! You have {} tasks'.format(number_of_tasks)
         update.message.reply_text(text=text, reply_markup=keyboard)
 
@@ -144,29 +239,77 @@ def tasks_menu(update: Update, context: CallbackContext) -> None:
     return SHOW_TASKS
 
 
+def add_page_buttons(buttons, opcode, offset, has_more):
+    row = []
+    if offset > 0:
+        row.append(InlineKeyboardButton(text='< Prev', callback_data=encode(opcode, max(offset - PAGE_SIZE, 0))))
+    if has_more:
+        row.append(InlineKeyboardButton(text='Next >', callback_data=encode(opcode, offset + PAGE_SIZE)))
+    if row:
+        buttons.append(row)
+
+
 def show_all_tasks(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    buttons = [
-        [InlineKeyboardButton(text='Back', callback_data=str(BACK_TO_TASK_MENU))]
-    ]
 
-    text = 'Here is the list of *ALL* tasks (even finished)'
-    if 'TASKS' not in user_data:
-        user_data['TASKS'] = []
+    # The opcode of a page gives the state filter, the first page of all tasks is plain ALL_TASKS
+    state_filter = ALL_TASKS_FILTERS.get(context.opcode, ANY_STATE)
+    offset = context.number or 0
+    states = () if state_filter == ANY_STATE else (state_filter,)
 
-    if 'TASKS' not in user_data or len(user_data['TASKS']) == 0:
+    tasks = get_tasks(user_data)
+    page, has_more = tasks.page(offset, PAGE_SIZE, *states)
+
+    if state_filter == ANY_STATE:
+        text = 'Here is the list of *ALL* tasks (even finished)'
+    else:
+        text = 'Here is the list of *{}* tasks'.format(state_filter.replace('_', ' '))
+    if not page:
         text = '\nYou have no any tasks'
     else:
-        tasks = user_data['TASKS']
-        for task in tasks:
-            text += '\nTask №{}: {}, duration: {}, deadline: {}'.format(task.id, task.name, task.duration,
-                                                                        task.deadline)
-    update.callback_query.answer()
+        text += ' ({}-{} of {})'.format(offset + 1, offset + len(page), tasks.count_with_deadline(*states))
+        for task in page:
+            text += '\nTask №{}: {}, duration: {}, deadline: {}'.format(tasks.number(task), task.name,
+                                                                        task.duration, format_time(task.deadline))
 
+    buttons = [
+        [InlineKeyboardButton(text=name, callback_data=encode(ALL_TASKS_PAGE_OPS[state], 0))
+         for name, state in (('All', ANY_STATE), ('New', NEW), ('In progress', IN_PROGRESS), ('Done', DONE))]
+    ]
+    add_page_buttons(buttons, ALL_TASKS_PAGE_OPS[state_filter], offset, has_more)
+    buttons.append([InlineKeyboardButton(text='Back', callback_data=str(BACK_TO_TASK_MENU))])
     keyboard = InlineKeyboardMarkup(buttons)
 
-    update.callback_query.answer()
-    update.callback_query.edit_message_text(text=text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+    edit_message(update, text=text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+    user_data[START_OVER] = False
+
+    return ALL_TASKS
+
+
+def show_plan(update: Update, context: CallbackContext) -> None:
+    user_data = context.user_data
+    tasks = get_tasks(user_data)
+    # Whole seconds for the times shown
+    now = int(time.time())
+
+    frog = tasks.next_frog()
+    if frog is None:
+        text = 'You have no tasks to plan'
+    else:
+        text = 'Eat this frog first: {}, deadline: {}'.format(frog.name, format_time(frog.deadline))
+        late = tasks.first_late(now)
+        if late is None:
+            text += '\n\nDone one after another by earliest deadline, all your tasks fit before their deadlines.'
+        else:
+            text += '\n\nNot everything fits: {} would miss its deadline by {:.1f} hours. Extend a deadline or ' \
+                    'drop a task.'.format(late[0].name, late[1] / 3600)
+        schedule = tasks.schedule(now, PAGE_SIZE)
+        if schedule:
+            text += '\n\nPlan of the new tasks:'
+        for task, start_at, end_at in schedule:
+            text += '\n{}: {} - {}'.format(task.name, format_time(start_at), format_time(end_at))
+
+    edit_message(update, text=text, reply_markup=BACK_TO_TASK_MENU_KEYBOARD)
     user_data[START_OVER] = False
 
     return ALL_TASKS
@@ -179,20 +322,15 @@ def stop(update: Update, context: CallbackContext) -> None:
 
 def add_new_task_name(update: Update, context: CallbackContext) -> None:
     text = 'Okay, please, write your task.'
-    update.callback_query.answer()
-    update.callback_query.edit_message_text(text=text)
+    edit_message(update, text=text)
     return TYPING_TASK_NAME
 
 
 def save_task_name(update: Update, context: CallbackContext) -> None:
-    global task_num
     user_data = context.user_data
     user_task_name = update.message.text
-    if 'TASKS' not in user_data:
-        user_data['TASKS'] = []
-    task_num += 1
-    task = Task(task_num, user_task_name, None, None, None, NEW)
-    user_data['TASKS'].append(task)
+    # The task is only added to the user's tasks once it has a deadline
+    user_data[DRAFT] = Task(task_ids.next_id(), user_task_name, None, None, NEW)
 
     text = 'Write duration of the task in hours (e.g. 10 means 10 hours).'
     update.message.reply_text(text)
@@ -201,13 +339,7 @@ def save_task_name(update: Update, context: CallbackContext) -> None:
 
 def add_new_task_duration(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    global task_num
-    task_number = task_num
-    element_number = 0
-    for i in range(0, len(user_data['TASKS'])):
-        if user_data['TASKS'][i].id == task_number:
-            element_number = i
-    user_data['TASKS'][element_number].duration = int(update.message.text)
+    user_data[DRAFT].duration = int(update.message.text)
     text = 'Write deadline of the task in the format YYYY-MM-DD HH:MM:SS, e.g. 2021-01-09 23:59'
     update.message.reply_text(text)
     return TYPING_TASK_DEADLINE
@@ -219,13 +351,53 @@ def add_new_task_deadline(update: Update, context: CallbackContext) -> None:
     if user_deadline <= datetime.now():
         update.message.reply_text(text='You can\'t add date in the past')
         return TYPING_TASK_DEADLINE
-    global task_num
-    task_number = task_num
-    element_number = 0
-    for i in range(0, len(user_data['TASKS'])):
-        if user_data['TASKS'][i].id == task_number:
-            element_number = i
-    user_data['TASKS'][element_number].deadline = user_deadline
+    task = user_data.pop(DRAFT)
+    task.deadline = user_deadline.timestamp()
+    get_tasks(user_data).add(task)
+    record_event(ADDED, update.effective_user.id, task)
+    user_data[START_OVER] = True
+    return tasks_menu(update, context)
+
+
+def import_tasks_prompt(update: Update, context: CallbackContext) -> None:
+    text = 'Send me the tasks, one per line as name, duration in hours, deadline, e.g.\n' \
+           'Write the report, 3, 2021-01-09 23:59\n\n' \
+           'You can also upload a CSV file with these columns or a JSON list of objects with ' \
+           'name, duration and deadline.'
+    edit_message(update, text=text)
+    return TYPING_IMPORT
+
+
+def import_tasks(update: Update, context: CallbackContext) -> None:
+    user_data = context.user_data
+    document = update.message.document
+    try:
+        if document is None:
+            rows = text_rows(update.message.text)
+        elif document.file_size and document.file_size > IMPORT_MAX_SIZE:
+            raise ValueError('The file is larger than {} KB'.format(IMPORT_MAX_SIZE // 1024))
+        else:
+            buffer = io.BytesIO()
+            document.get_file().download(out=buffer)
+            buffer.seek(0)
+            rows = document_rows(buffer, document.file_name or '')
+        parsed, errors = parse_tasks(rows, datetime.now())
+    except (ValueError, UnicodeDecodeError, csv.Error) as error:
+        parsed, errors = [], [str(error)]
+
+    if errors or not parsed:
+        errors = errors or ['There are no tasks to import']
+        text = 'Nothing was imported, please fix these and send the tasks again:\n' + '\n'.join(errors[:MAX_ERRORS])
+        if len(errors) > MAX_ERRORS:
+            text += '\n...and {} more'.format(len(errors) - MAX_ERRORS)
+        update.message.reply_text(text)
+        return TYPING_IMPORT
+
+    imported = [Task(task_ids.next_id(), name, duration, deadline, NEW) for name, duration, deadline in parsed]
+    get_tasks(user_data).add_many(imported)
+    for task in imported:
+        record_event(ADDED, update.effective_user.id, task)
+    update.message.reply_text('Imported {} tasks'.format(len(parsed)))
     user_data[START_OVER] = True
     return tasks_menu(update, context)
 
@@ -234,63 +406,123 @@ def get_task(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
     buttons = []
 
-    if 'TASKS' not in user_data or len(user_data['TASKS']) == 0:
-        text = 'You have no any tasks'
-    else:
-        tasks = sorted(user_data['TASKS'], key=lambda x: x.deadline)
-        for task in tasks:
-            if task.state != DONE:
-                if task.time_left is not None:
-                    if isinstance(task.time_left, timedelta):
-                        time_diff = task.time_left
-                    else:
-                        time_diff = task.time_left - datetime.now()
-                    text = '\nTask №{}: {}, duration: {}, deadline: {}, time left: {}' \
-                        .format(task.id, task.name, task.duration,
-                                task.deadline, str(timedelta(seconds=time_diff.total_seconds())))
-                else:
-                    text = '\nTask №{}: {}, duration: {}, deadline: {}' \
-                        .format(task.id, task.name, task.duration, task.deadline)
-                button = [InlineKeyboardButton(text=text, callback_data=str(task.id))]
-                buttons.append(button)
+    # Going back to the task list returns to the page the task was chosen from
+    if context.opcode == OP_PAGE:
+        user_data[TASK_PAGE] = context.number
+    elif context.opcode == GET_TASK:
+        user_data[TASK_PAGE] = 0
+        user_data.pop(SELECTED_TASKS, None)
+    offset = user_data.get(TASK_PAGE, 0)
+    # While selecting, choosing a task toggles it instead of opening it
+    selected = user_data.get(SELECTED_TASKS)
+
+    tasks = get_tasks(user_data)
+    page, has_more = tasks.page(offset, PAGE_SIZE, NEW, IN_PROGRESS)
+    if not page and offset > 0:
+        offset = user_data[TASK_PAGE] = max(offset - PAGE_SIZE, 0)
+        page, has_more = tasks.page(offset, PAGE_SIZE, NEW, IN_PROGRESS)
+
+    for task in page:
+        if task.ends_at is not None:
+            text = '\nTask №{}: {}, duration: {}, deadline: {}, time left: {}' \
+                .format(tasks.number(task), task.name, task.duration,
+                        format_time(task.deadline), str(timedelta(seconds=task.ends_at - time.time())))
+        else:
+            text = '\nTask №{}: {}, duration: {}, deadline: {}' \
+                .format(tasks.number(task), task.name, task.duration, format_time(task.deadline))
+        if selected is None:
+            button = [InlineKeyboardButton(text=text, callback_data=encode(OP_OPEN, task.id))]
+        else:
+            button = [InlineKeyboardButton(text=('[x] ' if task.id in selected else '[ ] ') + text.lstrip('\n'),
+                                           callback_data=encode(OP_SELECT, task.id))]
+        buttons.append(button)
 
+    add_page_buttons(buttons, OP_PAGE, offset, has_more)
+    if selected is None:
+        buttons.append([InlineKeyboardButton(text='Select tasks', callback_data=str(SELECT_TASKS))])
+    else:
+        buttons.append([InlineKeyboardButton(text=name, callback_data='{}_{}'.format(BATCH, action))
+                        for name, action in (('Finish', FINISH_TASK), ('Extend', EXTEND_TASK),
+                                             ('Delete', DELETE_TASK))])
+        buttons.append([InlineKeyboardButton(text='Cancel selection', callback_data=str(SELECT_TASKS))])
     back_button = [InlineKeyboardButton(text='Back', callback_data=str(BACK_TO_TASK_MENU))]
     buttons.append(back_button)
     keyboard = InlineKeyboardMarkup(buttons)
 
-    update.callback_query.answer()
-    update.callback_query.edit_message_text(text='*Choose the task*', reply_markup=keyboard,
-                                            parse_mode=ParseMode.MARKDOWN)
+    edit_message(update, text='*Choose the task*', reply_markup=keyboard,
+                 parse_mode=ParseMode.MARKDOWN)
 
     user_data[START_OVER] = False
     return ALL_TASKS
 
 
-def start_task(update: Update, context: CallbackContext) -> None:
+def toggle_selection(update: Update, context: CallbackContext) -> None:
+    if context.user_data.pop(SELECTED_TASKS, None) is None:
+        context.user_data[SELECTED_TASKS] = set()
+    return get_task(update, context)
+
+
+def select_task(update: Update, context: CallbackContext) -> None:
+    task_number = context.number
+    selected = context.user_data.setdefault(SELECTED_TASKS, set())
+    if task_number in selected:
+        selected.discard(task_number)
+    else:
+        selected.add(task_number)
+    return get_task(update, context)
+
+
+def batch_action(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    task_number = int(update.callback_query.data)
-    element_number = 0
-    for i in range(0, len(user_data['TASKS'])):
-        if user_data['TASKS'][i].id == task_number:
-            element_number = i
-    task_description = 'Task №{}: {}, duration: {}, deadline: {}'.format(user_data['TASKS'][element_number].id,
-                                                                         user_data['TASKS'][element_number].name,
-                                                                         user_data['TASKS'][element_number].duration,
-                                                                         user_data['TASKS'][element_number].deadline)
+    action = update.callback_query.data[len(BATCH) + 1:]
+    selected = user_data.pop(SELECTED_TASKS, None) or set()
+
+    tasks = get_tasks(user_data)
+    done = 0
+    for task_number in selected:
+        task = tasks.get(task_number)
+        if task is None:
+            continue
+        if action == FINISH_TASK:
+            done += finish(update, tasks, task)
+        elif action == EXTEND_TASK:
+            done += extend(update, context, tasks, task) is None
+        elif action == DELETE_TASK:
+            done += delete(update, tasks, task_number)
+
+    text = 'You\'ve {} {} of {} selected tasks'.format(BATCH_ACTIONS[action], done, len(selected))
+    edit_message(update, text=text, reply_markup=DONE_TO_TASK_CHOICE_KEYBOARD)
+    user_data[START_OVER] = True
+
+    return ALL_TASKS
+
+
+def render_task(task, number):
+    task_description = 'Task №{}: {}, duration: {}, deadline: {}'.format(number, task.name, task.duration,
+                                                                         format_time(task.deadline))
 
     buttons = [
-        [InlineKeyboardButton(text='Start', callback_data=str(STARTED_TASK + '_' + str(task_number)))],
-        [InlineKeyboardButton(text='Finish', callback_data=str(FINISH_TASK + '_' + str(task_number)))],
-        [InlineKeyboardButton(text='Extend Time', callback_data=str(EXTEND_TASK + '_' + str(task_number)))],
-        [InlineKeyboardButton(text='Delete', callback_data=str(DELETE_TASK + '_' + str(task_number)))],
+        [InlineKeyboardButton(text='Start', callback_data=encode(OP_START, task.id))],
+        [InlineKeyboardButton(text='Finish', callback_data=encode(OP_FINISH, task.id))],
+        [InlineKeyboardButton(text='Extend Time', callback_data=encode(OP_EXTEND, task.id))],
+        [InlineKeyboardButton(text='Delete', callback_data=encode(OP_DELETE, task.id))],
         [InlineKeyboardButton(text='Back', callback_data=str(BACK_TO_TASK_CHOICE))]
     ]
 
-    keyboard = InlineKeyboardMarkup(buttons)
+    return task_description, InlineKeyboardMarkup(buttons)
+
+
+def start_task(update: Update, context: CallbackContext) -> None:
+    user_data = context.user_data
+    task_number = context.number
+    tasks = get_tasks(user_data)
+    task = tasks.get(task_number)
+    if task is None:
+        return task_not_found(update, context)
+    task_description, keyboard = render_cache.get(task, render_task, tasks.number(task))
 
-    update.callback_query.answer()
-    update.callback_query.edit_message_text(text=task_description, reply_markup=keyboard,
-                                            parse_mode=ParseMode.MARKDOWN)
+    edit_message(update, text=task_description, reply_markup=keyboard,
+                 parse_mode=ParseMode.MARKDOWN)
 
     user_data[START_OVER] = False
 
@@ -299,76 +531,88 @@ def start_task(update: Update, context: CallbackContext) -> None:
 
 def proceed_task(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    callback_data = update.callback_query.data
     text = '*You\'ve successfuly started a task*'
-    task_number = int(callback_data.split('_', 3)[2])
-    for task in user_data['TASKS']:
-        if task.state == IN_PROGRESS:
-            buttons = [
-                [InlineKeyboardButton(text='Back', callback_data=str(END))]
-            ]
-            keyboard = InlineKeyboardMarkup(buttons)
-            context.user_data[START_OVER] = True
-            update.callback_query.edit_message_text(text='*You can\'t start a few tasks simultaneously*',
-                                                    reply_markup=keyboard,
-                                                    parse_mode=ParseMode.MARKDOWN)
-            return ALL_TASKS
-
-    element_number = 0
-    for i in range(0, len(user_data['TASKS'])):
-        if user_data['TASKS'][i].id == task_number:
-            element_number = i
-    user_data['TASKS'][element_number].state = IN_PROGRESS
-    if datetime.now() + timedelta(hours=user_data['TASKS'][element_number].duration) <= user_data['TASKS'][
-        element_number].deadline:
-        user_data['TASKS'][element_number].time_left = \
-            datetime.now() + timedelta(hours=user_data['TASKS'][element_number].duration)
-    else:
-        user_data['TASKS'][element_number].time_left = user_data['TASKS'][element_number].deadline - datetime.now()
-    set_timer(update, context, user_data['TASKS'][element_number], first_time=True)
+    task_number = context.number
+    tasks = get_tasks(user_data)
+    task = tasks.get(task_number)
+    if task is None:
+        return task_not_found(update, context)
+    if tasks.has_state(IN_PROGRESS):
+        context.user_data[START_OVER] = True
+        edit_message(update, text='*You can\'t start a few tasks simultaneously*', reply_markup=BACK_KEYBOARD,
+                     parse_mode=ParseMode.MARKDOWN)
+        return ALL_TASKS
+
+    tasks.set_state(task, IN_PROGRESS)
+    task.started_at = time.time()
+    task.ends_at = min(task.started_at + task.duration * 3600, task.deadline)
+    record_event(STARTED, update.effective_user.id, task)
+    render_cache.invalidate(task.id)
+    set_timer(update, context, task, first_time=True)
+
+    keyboard = DONE_KEYBOARD
+
+    edit_message(update, text=text, reply_markup=keyboard,
+                 parse_mode=ParseMode.MARKDOWN)
 
-    buttons = [
-        [InlineKeyboardButton(text='Done', callback_data=str(END))]
-    ]
+    user_data[START_OVER] = True
 
-    keyboard = InlineKeyboardMarkup(buttons)
+    return ALL_TASKS
 
-    update.callback_query.answer()
-    update.callback_query.edit_message_text(text=text, reply_markup=keyboard,
-                                            parse_mode=ParseMode.MARKDOWN)
 
-    user_data[START_OVER] = True
+def finish(update: Update, tasks, task):
+    """Mark a task as done, only a task in progress can be finished."""
+    if task.state != IN_PROGRESS:
+        return False
+    tasks.set_state(task, DONE)
+    record_event(FINISHED, update.effective_user.id, task)
+    render_cache.invalidate(task.id)
+    reminders.cancel(update.effective_chat.id, task.id, remind, remind_deadline)
+    return True
 
-    return ALL_TASKS
+
+def extend(update: Update, context: CallbackContext, tasks, task):
+    """Give a started task its duration once more, returns why it can't be extended otherwise."""
+    if task.ends_at is None:
+        return 'You can\'t extend the task that you haven\'t started yet.'
+    if task.ends_at + task.duration * 3600 >= task.deadline:
+        return 'You can\'t extend this task because of deadline.'
+    task.ends_at += task.duration * 3600
+    tasks.touch(task)
+    record_event(EXTENDED, update.effective_user.id, task)
+    render_cache.invalidate(task.id)
+    set_timer(update, context, task, first_time=False)
+    return None
+
+
+def delete(update: Update, tasks, task_id):
+    if tasks.remove(task_id) is None:
+        return False
+    if events is not None:
+        events.delete(update.effective_user.id, task_id)
+    render_cache.invalidate(task_id)
+    reminders.cancel(update.effective_chat.id, task_id, remind, remind_deadline)
+    return True
 
 
 def finish_task(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    callback_data = update.callback_query.data
     text = ''
-    task_number = int(callback_data.split('_', 3)[2])
-
-    buttons = [
-        [InlineKeyboardButton(text='Done', callback_data=str(BACK_TO_TASK_CHOICE))]
-    ]
+    task_number = context.number
 
-    keyboard = InlineKeyboardMarkup(buttons)
+    keyboard = DONE_TO_TASK_CHOICE_KEYBOARD
 
-    element_number = 0
-    for i in range(0, len(user_data['TASKS'])):
-        if user_data['TASKS'][i].id == task_number:
-            element_number = i
-    if user_data['TASKS'][element_number].state != IN_PROGRESS:
-        text = 'You can\'t finish the task that you haven\'t started'
-    else:
-        user_data['TASKS'][element_number].state = DONE
-        remove_job_if_exists(user_data['TASKS'][element_number].name + '_timeleft', context)
-        remove_job_if_exists(user_data['TASKS'][element_number].name + '_deadline', context)
+    tasks = get_tasks(user_data)
+    task = tasks.get(task_number)
+    if task is None:
+        return task_not_found(update, context)
+    if finish(update, tasks, task):
         text = '*You\'ve marked this task as done*'
+    else:
+        text = 'You can\'t finish the task that you haven\'t started'
 
-    update.callback_query.answer()
-    update.callback_query.edit_message_text(text=text, reply_markup=keyboard,
-                                            parse_mode=ParseMode.MARKDOWN)
+    edit_message(update, text=text, reply_markup=keyboard,
+                 parse_mode=ParseMode.MARKDOWN)
 
     user_data[START_OVER] = True
 
@@ -377,35 +621,19 @@ def finish_task(update: Update, context: CallbackContext) -> None:
 
 def extend_task_time_left(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    callback_data = update.callback_query.data
     text = 'You\'ve successfully extended time for this task.'
-    task_number = int(callback_data.split('_', 3)[2])
-
-    buttons = [
-        [InlineKeyboardButton(text='Done', callback_data=str(BACK_TO_TASK_CHOICE))]
-    ]
+    task_number = context.number
 
-    keyboard = InlineKeyboardMarkup(buttons)
+    keyboard = DONE_TO_TASK_CHOICE_KEYBOARD
 
-    element_number = 0
-    for i in range(0, len(user_data['TASKS'])):
-        if user_data['TASKS'][i].id == task_number:
-            element_number = i
-    if user_data['TASKS'][element_number].time_left is not None:
-        if not isinstance(user_data['TASKS'][element_number].time_left, timedelta) and (
-                user_data['TASKS'][element_number].time_left + timedelta(
-                hours=user_data['TASKS'][element_number].duration)) \
-                < user_data['TASKS'][element_number].deadline:
-            user_data['TASKS'][element_number].time_left += timedelta(hours=user_data['TASKS'][element_number].duration)
-            set_timer(update, context, user_data['TASKS'][element_number], first_time=False)
-        else:
-            text = 'You can\'t extend this task because of deadline.'
-    else:
-        text = 'You can\'t extend the task that you haven\'t started yet.'
+    tasks = get_tasks(user_data)
+    task = tasks.get(task_number)
+    if task is None:
+        return task_not_found(update, context)
+    text = extend(update, context, tasks, task) or text
 
-    update.callback_query.answer()
-    update.callback_query.edit_message_text(text=text, reply_markup=keyboard,
-                                            parse_mode=ParseMode.MARKDOWN)
+    edit_message(update, text=text, reply_markup=keyboard,
+                 parse_mode=ParseMode.MARKDOWN)
     user_data[START_OVER] = True
 
     return ALL_TASKS
@@ -413,117 +641,448 @@ def extend_task_time_left(update: Update, context: CallbackContext) -> None:
 
 def delete_task(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    callback_data = update.callback_query.data
-
-    task_number = int(callback_data.split('_', 3)[2])
+    task_number = context.number
 
-    element_number = 0
-    for i in range(0, len(user_data['TASKS'])):
-        if user_data['TASKS'][i].id == task_number:
-            element_number = i
-    del user_data['TASKS'][element_number]
+    if not delete(update, get_tasks(user_data), task_number):
+        return task_not_found(update, context)
 
-    buttons = [
-        [InlineKeyboardButton(text='Done', callback_data=str(BACK_TO_TASK_CHOICE))]
-    ]
-
-    keyboard = InlineKeyboardMarkup(buttons)
+    keyboard = DONE_TO_TASK_CHOICE_KEYBOARD
 
-    update.callback_query.answer()
-    update.callback_query.edit_message_text(text='*You\'ve deleted a task*', reply_markup=keyboard,
-                                            parse_mode=ParseMode.MARKDOWN)
+    edit_message(update, text='*You\'ve deleted a task*', reply_markup=keyboard,
+                 parse_mode=ParseMode.MARKDOWN)
 
     user_data[START_OVER] = True
 
     return ALL_TASKS
 
 
-def remind(context):
-    job = context.job
-    context.bot.send_message(job.context,
-                             text='This is a reminder that you currently do a {} task. If you '
-                                  'done with this task, don\'t forget to mark it as done, otherwise extend it\'s time.'
-                             .format(job.name[:-9]))
+@timed_job
+def remind(chat_id, task_name):
+    outbox.send_message(chat_id,
+                        text='This is a reminder that you currently do a {} task. If you '
+                             'done with this task, don\'t forget to mark it as done, otherwise extend it\'s time.'
+                        .format(task_name))
 
 
-def remind_deadline(context):
-    job = context.job
-    context.bot.send_message(job.context,
-                             text='This is a reminder that you currently do a {} task. You have only 2 hours left for '
-                                  'this task, so don\'t forget to mark it as done. '
-                             .format(job.name[:-9]))
+@timed_job
+def remind_deadline(chat_id, task_name):
+    outbox.send_message(chat_id,
+                        text='This is a reminder that you currently do a {} task. You have only {:g} hours left for '
+                             'this task, so don\'t forget to mark it as done. '
+                        .format(task_name, deadline_notice() / 3600))
 
 
-def remove_job_if_exists(name, context):
-    current_jobs = context.job_queue.get_jobs_by_name(name)
-    if not current_jobs:
-        return False
-    for job in current_jobs:
-        job.schedule_removal()
-    return True
+def deadline_notice():
+    return float(os.getenv("REMINDER_DEADLINE_NOTICE", 2)) * 3600
 
 
 def set_timer(update: Update, context: CallbackContext, task, first_time) -> None:
-    # for production
-    # datetime_with_duration = datetime.today() + timedelta(hours=task.duration)
-    # context.job_queue.run_once(remind, datetime_with_duration, context=update.effective_chat.id, name=str(task.name + '_timeleft'))
-    # for presentation
-    context.job_queue.run_once(remind, timedelta(seconds=25), context=update.effective_chat.id, name=str(task.name + '_timeleft'))
+    if os.getenv("REMINDER_MODE") == 'digest':
+        return
+    # By default the reminder comes when the time of the task runs out, e.g. REMINDER_DELAY=25 for a presentation
+    delay = os.getenv("REMINDER_DELAY")
+    reminders.schedule(update.effective_chat.id, task, remind, time.time() + float(delay) if delay else task.ends_at)
     if first_time:
-        context.job_queue.run_once(remind_deadline, task.deadline - timedelta(hours=2),
-                                   context=update.effective_chat.id,
-                                   name=str(task.name + '_deadline'))
+        reminders.schedule(update.effective_chat.id, task, remind_deadline, task.deadline - deadline_notice())
+
+
+def digest_name(task):
+    if len(task.name) <= DIGEST_NAME_LENGTH:
+        return task.name
+    return task.name[:DIGEST_NAME_LENGTH - 1] + '…'
+
+
+def digest_section(title, lines, total):
+    """A digest section listing lines, the first ones of total, with the count of the others."""
+    text = '\n\n{}:\n'.format(title) + '\n'.join(lines)
+    if total > len(lines):
+        text += '\n…and {} more'.format(total - len(lines))
+    return text
+
+
+def build_digest(tasks, now, horizon):
+    """Text of the digest of a user's tasks, None if no task needs attention.
+
+    One pass over the deadline index, stopping at the first deadline past the horizon. Every
+    section lists its first DIGEST_SECTION_LINES tasks and counts the others, so that the digest
+    of a user with many tasks still fits in a message.
+    """
+    overdue = []
+    upcoming = []
+    overdue_count = upcoming_count = 0
+    for task in tasks.by_deadline(NEW, IN_PROGRESS):
+        if task.deadline > now + horizon:
+            break
+        if task.deadline <= now:
+            overdue_count += 1
+            if len(overdue) < DIGEST_SECTION_LINES:
+                overdue.append('{}: the deadline has passed'.format(digest_name(task)))
+        else:
+            upcoming_count += 1
+            if len(upcoming) < DIGEST_SECTION_LINES:
+                upcoming.append('{}: deadline {}'.format(digest_name(task), format_time(task.deadline)))
+    # Only one task can be in progress, it goes first
+    for task in tasks.by_deadline(IN_PROGRESS):
+        if task.ends_at <= now < task.deadline:
+            overdue_count += 1
+            overdue.insert(0, '{}: the time for it has run out, finish or extend it'.format(digest_name(task)))
+            del overdue[DIGEST_SECTION_LINES:]
+
+    if not overdue and not upcoming:
+        return None
+    text = 'Your agenda'
+    if overdue:
+        text += digest_section('Overdue', overdue, overdue_count)
+    if upcoming:
+        text += digest_section('Due in the next {:g} hours'.format(horizon / 3600), upcoming, upcoming_count)
+    return text
+
+
+@timed_job
+def send_digests(context: CallbackContext) -> None:
+    """Send every user with overdue or upcoming tasks one message about all of them."""
+    now = time.time()
+    horizon = float(os.getenv("DIGEST_HORIZON", 24)) * 3600
+    for user_id, data in list(context.dispatcher.user_data.items()):
+        if 'TASKS' not in data:
+            continue
+        text = build_digest(data['TASKS'], now, horizon)
+        # An agenda the user has already got is not sent again
+        if text is None:
+            sent_digests.pop(user_id, None)
+        elif sent_digests.get(user_id) != text:
+            outbox.send_message(user_id, text=text)
+            sent_digests[user_id] = text
+
+
+def restore_reminders(dispatcher, alive_until=None) -> int:
+    """Schedule the reminders of the in progress tasks restored from persistence.
+
+    The bot only talks in private chats, so the user id is the chat id of the reminders.
+    Tasks are streamed from the per-user state indexes into a single heapify. Reminders due by
+    alive_until, the last time the previous run was known to be up, were already sent; the ones
+    due while the bot was down are sent right away.
+    """
+    now = time.time()
+    alive_until = alive_until or 0
+
+    def pending():
+        for user_id, data in dispatcher.user_data.items():
+            if 'TASKS' not in data:
+                continue
+            for task in data['TASKS'].by_deadline(IN_PROGRESS):
+                if task.ends_at > alive_until:
+                    yield user_id, task, remind, max(task.ends_at, now)
+                if task.deadline > now and task.deadline - deadline_notice() > alive_until:
+                    yield user_id, task, remind_deadline, max(task.deadline - deadline_notice(), now)
+
+    reminders.schedule_many(pending())
+    return len(reminders)
+
+
+def last_alive(persistence):
+    """Last time the previous run was known to be up, from its last flush or event log sync."""
+    times = [getattr(persistence, 'flushed_at', None), events and events.synced_at]
+    return max(filter(None, times), default=None)
+
+
+def persistence_path():
+    default = 'eatthefrogbot.sqlite' if os.getenv("PERSISTENCE") == 'sqlite' else 'eatthefrogbot.pickle'
+    return os.getenv("PERSISTENCE_PATH", default)
+
+
+def create_persistence(path=None, lazy=False):
+    backend = os.getenv("PERSISTENCE")
+    if backend == 'sqlite':
+        from persistence import SQLitePersistence
+        return SQLitePersistence(path or persistence_path(), lazy=lazy)
+    if backend == 'file':
+        from persistence import FilePersistence
+        return FilePersistence(path or persistence_path())
+    return None
+
+
+def flush_persistence(context):
+    context.dispatcher.persistence.flush()
+
+
+def sync_events(context):
+    events.sync()
+
+
+def compact_events(context):
+    events.compact()
+
+
+def setup_events(updater, path, persistence):
+    """Log the task events to path, recovering the tasks from it when there is no other persistence."""
+    global events
+    events = EventLog(path)
+    if persistence is None:
+        stores = events.load()
+        for user_id, tasks in stores.items():
+            updater.dispatcher.user_data[user_id]['TASKS'] = tasks
+        logging.info('Recovered the tasks of %d users from %s', len(stores), path)
+    run_repeating(updater.job_queue, sync_events, float(os.getenv("EVENT_LOG_SYNC_INTERVAL", 1)))
+    run_repeating(updater.job_queue, compact_events, float(os.getenv("EVENT_LOG_COMPACT_INTERVAL", 3600)))
+
+
+TEXT_INPUT = Filters.text & ~Filters.command
+
+# The conversation: routes of the buttons of every state, from their callback_data or opcode to
+# their callback, and filter and callback of the messages typed in it
+BUTTONS = {
+    SELECTING_ACTION: {PROCRASTINATION: show_procrastination, TASKS_MENU: tasks_menu, END: end},
+    PROCRASTINATION: {END: start},
+    SHOW_TASKS: {ALL_TASKS: show_all_tasks, SHOW_PLAN: show_plan, ADD_NEW_TASK: add_new_task_name,
+                 IMPORT_TASKS: import_tasks_prompt, GET_TASK: get_task, TYPING_TASK_NAME: start, END: start},
+    ALL_TASKS: {
+        OP_OPEN: start_task,
+        BACK_TO_TASK_CHOICE: get_task,
+        OP_PAGE: get_task,
+        **{opcode: show_all_tasks for opcode in ALL_TASKS_FILTERS},
+        BACK_TO_TASK_MENU: tasks_menu,
+        OP_START: proceed_task,
+        OP_FINISH: finish_task,
+        OP_EXTEND: extend_task_time_left,
+        OP_DELETE: delete_task,
+        SELECT_TASKS: toggle_selection,
+        OP_SELECT: select_task,
+        **{'{}_{}'.format(BATCH, action): batch_action for action in BATCH_ACTIONS},
+        END: start,
+    },
+}
+MESSAGES = {
+    TYPING_TASK_NAME: (TEXT_INPUT, save_task_name),
+    TYPING_TASK_DURATION: (TEXT_INPUT, add_new_task_duration),
+    TYPING_TASK_DEADLINE: (TEXT_INPUT, add_new_task_deadline),
+    TYPING_IMPORT: (TEXT_INPUT | Filters.document, import_tasks),
+}
+
+
+def build_conversation_handler(persistent=False, run_async=False):
+    # Each conversation gets its own copy of the routes, instrument() wraps their callbacks
+    states = {state: [CallbackRouter(dict(routes))] for state, routes in BUTTONS.items()}
+    for state, (message_filter, callback) in MESSAGES.items():
+        states[state] = [MessageHandler(message_filter, callback)]
+    conversation_handler = instrument(ConversationHandler(
+        entry_points=[CommandHandler('start', start)],
+        states=states,
+        fallbacks=[CommandHandler('stop', stop)],
+        map_to_parent={
+            END: SELECTING_ACTION,
+        },
+        name=CONVERSATION_NAME,
+        persistent=persistent
+    ))
+    if run_async:
+        for handlers in [conversation_handler.entry_points, conversation_handler.fallbacks,
+                         *conversation_handler.states.values()]:
+            for handler in handlers:
+                handler.run_async = True
+        # Updates of a chat arriving while its previous one is still handled go to the WAITING state,
+        # answered right away by the dispatcher so that the pending state is left as it is
+        conversation_handler.states[ConversationHandler.WAITING] = [TypeHandler(Update, still_busy)]
+    return conversation_handler
+
+
+def create_bot(token, workers):
+    # Kept-alive connections for the dispatcher workers, the answers pool and the updater, jobs and outbox threads
+    return ExtBot(token, request=TimedRequest(con_pool_size=workers + ANSWER_THREADS + 4))
+
+
+def setup_metrics(updater, port):
+    """Serve the metrics of this process on the given port."""
+    registry.profile_sample_rate = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+    registry.gauge('update_queue_depth', updater.dispatcher.update_queue.qsize)
+    registry.gauge('pending_jobs', lambda: len(updater.job_queue.jobs()))
+    registry.gauge('pending_reminders', lambda: len(reminders))
+    registry.gauge('startup_seconds', lambda: startup.elapsed)
+    registry.gauge('outbound_queue_depth', lambda: outbox.depth)
+    for name in outbox.counters:
+        registry.gauge('outbound_messages_' + name, lambda name=name: outbox.counters[name])
+    registry.gauge('outbound_latency_seconds_sum', lambda: outbox.latency_total)
+    registry.gauge('outbound_latency_seconds_max', lambda: outbox.latency_max)
+    for name in debouncer.counters:
+        registry.gauge('callback_updates_' + name, lambda name=name: debouncer.counters[name])
+    registry.gauge('render_cache_hits', lambda: render_cache.hits)
+    registry.gauge('render_cache_misses', lambda: render_cache.misses)
+    registry.collector('tasks_per_user', lambda: tasks_per_user(updater.dispatcher.user_data))
+    start_server(port)
+
+
+def record_updates(dispatcher, path):
+    """Append every update to path as a line of JSON, to be replayed by benchmark.py."""
+    log = open(path, 'a', buffering=1)
+    dispatcher.add_handler(TypeHandler(Update, lambda update, context: log.write(update.to_json() + '\n')),
+                           group=-2)
+
+
+def run_repeating(job_queue, callback, interval):
+    """job_queue.run_repeating with the trigger built here.
+
+    Given the trigger by name, APScheduler looks it up through the package entry points, resolving
+    the requirements of every installed distribution on the first job, which is a good part of a cold start.
+    """
+    from apscheduler.triggers.interval import IntervalTrigger
+
+    return job_queue.run_custom(callback, {'trigger': IntervalTrigger(seconds=interval,
+                                                                      timezone=job_queue.scheduler.timezone)})
+
+
+def run_once(job_queue, callback):
+    """job_queue.run_once right away, with the trigger built here as in run_repeating."""
+    from apscheduler.triggers.date import DateTrigger
+
+    return job_queue.run_custom(callback, {'trigger': DateTrigger(timezone=job_queue.scheduler.timezone)})
+
+
+def load_users(context: CallbackContext) -> None:
+    """Load the users left out by a fast start, in the background."""
+    started = time.perf_counter()
+    user_data = context.dispatcher.user_data
+    user_data.load(context.dispatcher.persistence.user_ids())
+    logging.info('Loaded %d users in %.1f s', len(user_data), time.perf_counter() - started)
+
+
+def setup_dispatcher(updater, persistence, event_log=None):
+    """Register the handlers and the jobs of the bot, restoring the persisted state."""
+    dispatcher = updater.dispatcher
+
+    # Double taps on a button are answered before reaching the conversation
+    debouncer.window = float(os.getenv("DEBOUNCE_WINDOW", 1))
+    if debouncer.window > 0:
+        dispatcher.add_handler(TypeHandler(Update, debouncer), group=-1)
+    dispatcher.add_handler(build_conversation_handler(persistent=persistence is not None,
+                                                      run_async=bool(os.getenv("RUN_ASYNC"))))
+
+    digest = os.getenv("REMINDER_MODE") == 'digest'
+    if event_log:
+        setup_events(updater, event_log, persistence)
+    if getattr(persistence, 'lazy', False):
+        # Users are loaded on their first update, the ones with reminders now and the others in the background
+        if not digest:
+            dispatcher.user_data.load(persistence.user_ids(IN_PROGRESS))
+        run_once(updater.job_queue, load_users)
+    if (persistence is not None or event_log) and not digest:
+        logging.info('Restored %d reminders', restore_reminders(dispatcher, last_alive(persistence)))
+    if persistence is not None:
+        # Writes are batched, handlers only mark the data as changed
+        run_repeating(updater.job_queue, flush_persistence, float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 5)))
+
+    if digest:
+        run_repeating(updater.job_queue, send_digests, float(os.getenv("DIGEST_INTERVAL", 3600)))
+    else:
+        run_repeating(updater.job_queue, reminders.tick, float(os.getenv("REMINDER_TICK_INTERVAL", 1)))
+
+
+def run_shard(index, shards, queue):
+    """Worker process owning the chats, tasks and reminders of one shard."""
+    from sharding import serve, shard_path
+
+    # Forked from the front process, the modules are already imported
+    global startup, task_ids
+    startup = StartupTimer()
+    # Metrics recorded by the front process before the fork are not this shard's
+    registry.reset()
+    # Task ids of the shards differ by the worker id
+    task_ids = IdAllocator(index)
+    persistence = create_persistence(shard_path(persistence_path(), index, shards), lazy=bool(os.getenv("FAST_START")))
+    startup.mark('persistence')
+    workers = int(os.getenv("WORKERS", 4))
+    updater = Updater(bot=create_bot(os.getenv("BOT_TOKEN"), workers), workers=workers, persistence=persistence,
+                      use_context=True)
+    updater.dispatcher.add_handler(TypeHandler(Update, startup), group=-3)
+    if os.getenv("METRICS_PORT"):
+        setup_metrics(updater, int(os.getenv("METRICS_PORT")) + 1 + index)
+    startup.mark('updater')
+    event_log = os.getenv("EVENT_LOG")
+    setup_dispatcher(updater, persistence, event_log and shard_path(event_log, index, shards))
+    outbox.start(updater.bot)
+    startup.mark('handlers')
+    serve(updater, queue)
+    outbox.stop()
+    if events is not None:
+        events.close()
 
 
 def main():
+    startup.mark('imports')
+    # Optional subsystems are imported when configured, a restarted worker only pays for what it runs
+    from dotenv import load_dotenv
+
     load_dotenv()
+    startup.mark('config')
     token = os.getenv("BOT_TOKEN")
-    updater = Updater(token, use_context=True)
+    shards = int(os.getenv("SHARDS", 1))
+    webhook_url = os.getenv("WEBHOOK_URL")
+    workers = int(os.getenv("WORKERS", 4))
+
+    if os.getenv("PERSISTENCE"):
+        from sharding import rebalance
+        rebalance(create_persistence, persistence_path(), shards, CONVERSATION_NAME)
+    if os.getenv("EVENT_LOG"):
+        from sharding import rebalance_events
+        rebalance_events(os.getenv("EVENT_LOG"), shards)
+    # With shards the front process only receives updates, the workers own all the state
+    persistence = create_persistence(lazy=bool(os.getenv("FAST_START"))) if shards == 1 else None
+    startup.mark('persistence')
+
+    if webhook_url:
+        from webhook import WebhookUpdater
+        updater = WebhookUpdater(bot=create_bot(token, workers), workers=workers, persistence=persistence,
+                                 use_context=True,
+                                 secret_token=os.getenv("WEBHOOK_SECRET"),
+                                 max_queue_size=int(os.getenv("WEBHOOK_MAX_QUEUE_SIZE", 1000)))
+    else:
+        updater = Updater(bot=create_bot(token, workers), workers=workers, persistence=persistence, use_context=True)
+    updater.dispatcher.add_handler(TypeHandler(Update, startup), group=-3)
 
-    # Get the dispatcher to register handlers
-    dispatcher = updater.dispatcher
+    if os.getenv("METRICS_PORT"):
+        # Workers of a sharded setup serve theirs on the following ports
+        setup_metrics(updater, int(os.getenv("METRICS_PORT")))
 
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
-        states={
-            SELECTING_ACTION: [CallbackQueryHandler(show_procrastination, pattern='^' + str(PROCRASTINATION) + '$'),
-                               CallbackQueryHandler(tasks_menu, pattern='^' + str(TASKS_MENU) + '$'),
-                               CallbackQueryHandler(end, pattern='^' + str(END) + '$')],
-            PROCRASTINATION: [CallbackQueryHandler(start, pattern='^' + str(END) + '$')],
-            SHOW_TASKS: [CallbackQueryHandler(show_all_tasks, pattern='^' + str(ALL_TASKS) + '$'),
-                         CallbackQueryHandler(add_new_task_name, pattern='^' + str(ADD_NEW_TASK) + '$'),
-                         CallbackQueryHandler(get_task, pattern='^' + str(GET_TASK + '$')),
-                         CallbackQueryHandler(start, pattern='^' + str(TYPING_TASK_NAME) + '$'),
-                         CallbackQueryHandler(start, pattern='^' + str(END) + '$')],
-            ALL_TASKS: [CallbackQueryHandler(start_task, pattern='^' + str('\d+') + '$'),
-                        CallbackQueryHandler(get_task, pattern='^' + str(BACK_TO_TASK_CHOICE) + '$'),
-                        CallbackQueryHandler(tasks_menu, pattern='^' + str(BACK_TO_TASK_MENU) + '$'),
-                        CallbackQueryHandler(proceed_task, pattern='^' + str(STARTED_TASK) + '_' + str('\d+') + '$'),
-                        CallbackQueryHandler(finish_task, pattern='^' + str(FINISH_TASK) + '_' + str('\d+') + '$'),
-                        CallbackQueryHandler(extend_task_time_left,
-                                             pattern='^' + str(EXTEND_TASK) + '_' + str('\d+') + '$'),
-                        CallbackQueryHandler(delete_task, pattern='^' + str(DELETE_TASK) + '_' + str('\d+') + '$'),
-                        CallbackQueryHandler(start, pattern='^' + str(END) + '$')],
-            TYPING_TASK_NAME: [MessageHandler(Filters.text & ~Filters.command, save_task_name)],
-            TYPING_TASK_DURATION: [MessageHandler(Filters.text & ~Filters.command, add_new_task_duration)],
-            TYPING_TASK_DEADLINE: [MessageHandler(Filters.text & ~Filters.command, add_new_task_deadline)]
-        },
-        fallbacks=[CommandHandler('stop', stop)],
-        map_to_parent={
-            END: SELECTING_ACTION,
-        }
-    )
+    if os.getenv("UPDATE_LOG"):
+        record_updates(updater.dispatcher, os.getenv("UPDATE_LOG"))
+    startup.mark('updater')
 
-    dispatcher.add_handler(conv_handler)
+    if shards > 1:
+        from sharding import ShardRouter, start_workers, stop_workers
+        processes, queues = start_workers(run_shard, shards, int(os.getenv("SHARD_QUEUE_SIZE", 1000)))
+        updater.dispatcher.add_handler(TypeHandler(Update, ShardRouter(queues)))
+    else:
+        setup_dispatcher(updater, persistence, os.getenv("EVENT_LOG"))
+        outbox.start(updater.bot)
+    startup.mark('handlers')
 
     # Start the Bot
-    updater.start_polling()
+    if webhook_url:
+        updater.start_webhook(listen=os.getenv("WEBHOOK_LISTEN", '0.0.0.0'),
+                              port=int(os.getenv("WEBHOOK_PORT", 8443)),
+                              url_path=os.getenv("WEBHOOK_PATH", ''),
+                              cert=os.getenv("WEBHOOK_CERT"),
+                              key=os.getenv("WEBHOOK_KEY"),
+                              bootstrap_retries=int(os.getenv("WEBHOOK_BOOTSTRAP_RETRIES", 0)),
+                              webhook_url=webhook_url,
+                              max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40)))
+    else:
+        updater.start_polling()
+    startup.mark('polling')
+    logging.info('Started in %.1f ms: %s', startup.elapsed * 1000, startup.summary())
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
+    # start_polling() and start_webhook() are non-blocking and will stop the bot
+    # gracefully.
     updater.idle()
 
+    if shards > 1:
+        stop_workers(processes, queues)
+    else:
+        outbox.stop()
+        if events is not None:
+            events.close()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,183 @@
+import gc
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+from threading import Lock
+
+from tasks import Task, TaskStore, STATES
+
+logger = logging.getLogger(__name__)
+
+ADDED, STARTED, EXTENDED, FINISHED, DELETED = range(1, 6)
+
+# Length of the rest of the record, event, time, user id, task id
+HEADER = struct.Struct('<IBdqq')
+# State, duration (-1 for none), deadline, started at, ends at (NaN for none), then the name in UTF-8
+TASK = struct.Struct('<Bi3d')
+RECORD = struct.Struct(HEADER.format + TASK.format[1:])
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+
+def encode(event, user_id, task_id, task=None):
+    if task is None:
+        return HEADER.pack(HEADER.size - 4, event, time.time(), user_id, task_id)
+    name = task.name.encode()
+    return HEADER.pack(HEADER.size - 4 + TASK.size + len(name), event, time.time(), user_id, task_id) + TASK.pack(
+        STATE_CODES[task.state], -1 if task.duration is None else task.duration,
+        *(math.nan if value is None else value for value in (task.deadline, task.started_at, task.ends_at))
+    ) + name
+
+
+def decode_task(buffer, position, end):
+    # Header and task in one unpack, recovery decodes every live task
+    _, _, _, _, task_id, state, duration, deadline, started_at, ends_at = RECORD.unpack_from(buffer, position)
+    name = buffer[position + RECORD.size:end].decode()
+    return Task(task_id, name, None if duration < 0 else duration, None if deadline != deadline else deadline,
+                STATES[state], None if started_at != started_at else started_at,
+                None if ends_at != ends_at else ends_at)
+
+
+def scan(buffer, latest, offset=0):
+    """Record in latest the position of the last event of every task in buffer, dropping deleted tasks.
+
+    Returns the offset after the last complete record, a standby process can call it again from
+    there as the log grows. Events carry the whole task, so replaying one twice changes nothing.
+    """
+    size = len(buffer)
+    unpack = HEADER.unpack_from
+    position = offset
+    while position + HEADER.size <= size:
+        length, event, _, user_id, task_id = unpack(buffer, position)
+        end = position + 4 + length
+        if end > size:
+            # Torn write at the end of the log
+            break
+        if event == DELETED:
+            latest.pop((user_id, task_id), None)
+        else:
+            latest[(user_id, task_id)] = (buffer, position, end)
+        position = end
+    return position
+
+
+def load(*paths):
+    """Replay the snapshot and logs at paths in order, returning the TaskStore of every user."""
+    maps = []
+    latest = {}
+    # Millions of tasks are created and nothing is garbage, collections would only walk them over and over
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        for path in paths:
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                continue
+            with open(path, 'rb') as file:
+                maps.append(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+            scan(maps[-1], latest)
+
+        tasks = {}
+        for (user_id, _), (buffer, position, end) in latest.items():
+            tasks.setdefault(user_id, []).append(decode_task(buffer, position, end))
+        latest.clear()
+        stores = {}
+        for user_id, user_tasks in tasks.items():
+            stores[user_id] = TaskStore()
+            stores[user_id].add_many(user_tasks)
+        return stores
+    finally:
+        for buffer in maps:
+            buffer.close()
+        if collecting:
+            gc.enable()
+
+
+def log_paths(path):
+    """Snapshot and logs of the event log at path, in replay order."""
+    return path + '.snapshot', path + '.old', path
+
+
+def write_snapshot(path, stores):
+    """Atomically write one ADDED event for every task of stores to path."""
+    with open(path + '.tmp', 'wb') as file:
+        for user_id, tasks in stores.items():
+            file.write(b''.join(encode(ADDED, user_id, task.id, task) for task in tasks))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def truncate_torn(path):
+    """Cut a record torn by a crash off the end of the log at path, so that appends start on a boundary."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, 'r+b') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            size = len(buffer)
+            end = scan(buffer, {})
+        if end < size:
+            logger.warning('Dropping a torn record of %d bytes at the end of %s', size - end, path)
+            file.truncate(end)
+
+
+class EventLog:
+    """Append-only log of task events, compacted into a snapshot from time to time.
+
+    Files: path is the log being written, path.old a log being compacted and path.snapshot one
+    ADDED event for every task alive at the last compaction. Replaying them in the order
+    snapshot, old, log gives the current tasks.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._compact_lock = Lock()
+        # Touched by every sync, so this is the last time the previous run was alive
+        self.synced_at = os.path.getmtime(path) if os.path.exists(path) else None
+        truncate_torn(path)
+        self._file = open(path, 'ab')
+
+    def paths(self):
+        return log_paths(self.path)
+
+    def load(self):
+        return load(*self.paths())
+
+    def record(self, event, user_id, task):
+        self._write(encode(event, user_id, task.id, task))
+
+    def delete(self, user_id, task_id):
+        self._write(encode(DELETED, user_id, task_id))
+
+    def sync(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            os.utime(self.path)
+
+    def compact(self):
+        """Fold the log into the snapshot; events keep being appended to a fresh log meanwhile."""
+        snapshot, old, path = self.paths()
+        with self._compact_lock:
+            # An old log left by an interrupted compaction is folded in first
+            if not os.path.exists(old):
+                with self._lock:
+                    self._file.close()
+                    os.replace(path, old)
+                    self._file = open(path, 'ab')
+            stores = load(snapshot, old)
+            write_snapshot(snapshot, stores)
+            os.remove(old)
+            logger.info('Compacted %s into %d users', path, len(stores))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _write(self, data):
+        with self._lock:
+            self._file.write(data)
+            # Handed to the OS right away, fsync is left to sync()
+            self._file.flush()
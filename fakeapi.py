@@ -0,0 +1,171 @@
+"""Local fake of the Bot API for checking the outbound queue without reaching Telegram.
+
+    python fakeapi.py                                   # runs every check, exits with 1 on a failure
+    python fakeapi.py --checks flood,coalescing
+
+The server answers sendMessage like Telegram does and can answer the next calls with 429 and a
+retry_after, every call is recorded with the time it arrived.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from telegram import Bot
+
+from sender import OutboundQueue
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'TakeTheFrogBot', 'username': 'TakeTheFrogBot'}
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        api = self.server
+        data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        method = self.path.rsplit('/', 1)[-1]
+        chat_id = int(data['chat_id']) if 'chat_id' in data else None
+        with api.lock:
+            api.calls.append((time.monotonic(), method, chat_id, data.get('text')))
+            flooded = api.flood > 0
+            api.flood -= flooded
+        if flooded:
+            status, body = 429, {'ok': False, 'error_code': 429,
+                                 'description': 'Too Many Requests: retry after {}'.format(api.retry_after),
+                                 'parameters': {'retry_after': api.retry_after}}
+        elif method == 'sendMessage':
+            status, body = 200, {'ok': True, 'result': {
+                'message_id': len(api.calls), 'date': int(time.time()), 'from': BOT_USER, 'text': data.get('text'),
+                'chat': {'id': chat_id, 'type': 'private'}}}
+        else:
+            status, body = 200, {'ok': True, 'result': True}
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeAPI(ThreadingHTTPServer):
+    """Bot API on a local port, recording (time, method, chat id, text) of every call in calls."""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), FakeAPIHandler)
+        self.lock = Lock()
+        self.calls = []
+        self.flood = 0
+        self.retry_after = 1
+        Thread(target=self.serve_forever, name='fake_api', daemon=True).start()
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}/bot'.format(*self.server_address)
+
+    def flood_next(self, calls, retry_after):
+        """Answer the next calls with 429 and retry_after."""
+        with self.lock:
+            self.flood = calls
+            self.retry_after = retry_after
+
+
+def deliver(api, messages, timeout=30, **kwargs):
+    """Send (chat id, text) messages through a fresh outbound queue, returning it once they are all sent."""
+    outbox = OutboundQueue(**kwargs)
+    for chat_id, text in messages:
+        outbox.send_message(chat_id, text)
+    outbox.start(Bot('123:fake', base_url=api.base_url))
+    outbox.stop(timeout)
+    return outbox
+
+
+def check_coalescing(api):
+    outbox = deliver(api, [(1, 'reminder'), (1, 'reminder'), (1, 'deadline'), (1, 'reminder'), (2, 'reminder')])
+    texts = sorted((chat_id, text) for _, _, chat_id, text in api.calls)
+    failures = []
+    if texts != [(1, 'deadline'), (1, 'reminder'), (2, 'reminder')]:
+        failures.append('expected one message per distinct text and chat, got {}'.format(texts))
+    if outbox.counters['coalesced'] != 2:
+        failures.append('expected 2 coalesced messages, counted {}'.format(outbox.counters['coalesced']))
+    return failures
+
+
+def check_flood(api):
+    """The first call gets a 429, nothing may reach the API before retry_after, then every message is sent."""
+    api.flood_next(1, 2)
+    outbox = deliver(api, [(chat_id, 'reminder') for chat_id in range(1, 6)])
+    calls = [(at, chat_id) for at, method, chat_id, _ in api.calls if method == 'sendMessage']
+    failures = []
+    if sorted(chat_id for _, chat_id in calls[1:]) != [1, 2, 3, 4, 5]:
+        failures.append('expected every chat to get its message after the 429, got {}'.format(calls))
+    elif calls[1][0] - calls[0][0] < 2 - 0.05:
+        failures.append('retried {:.2f} s after a retry_after of 2 s'.format(calls[1][0] - calls[0][0]))
+    if outbox.counters['retried'] != 1 or outbox.counters['sent'] != 5:
+        failures.append('expected 1 retried and 5 sent, counted {}'.format(outbox.counters))
+    return failures
+
+
+def check_chat_rate(api):
+    """A chat over its per-chat rate is spaced out without holding up the other chats.
+
+    Chat 1 uses up its burst, then gets more messages right before chat 2 gets one.
+    """
+    outbox = OutboundQueue(chat_rate=1, chat_burst=3)
+    outbox.start(Bot('123:fake', base_url=api.base_url))
+    for i in range(3):
+        outbox.send_message(1, 'burst {}'.format(i))
+    while outbox.counters['sent'] < 3:
+        time.sleep(0.01)
+    for i in range(3):
+        outbox.send_message(1, 'message {}'.format(i))
+    outbox.send_message(2, 'other')
+    queued = time.monotonic()
+    outbox.stop(30)
+
+    calls = [(at, chat_id) for at, method, chat_id, _ in api.calls if method == 'sendMessage']
+    first = [at for at, chat_id in calls if chat_id == 1]
+    other = [at for at, chat_id in calls if chat_id == 2]
+    failures = []
+    if len(first) != 6 or len(other) != 1:
+        failures.append('expected 6 messages to chat 1 and 1 to chat 2, got {}'.format(calls))
+        return failures
+    # A burst of 3, then one per second
+    if first[-1] - first[0] < 3 - 0.05:
+        failures.append('chat 1 got 6 messages in {:.2f} s, faster than 1 per second after a burst of 3'
+                        .format(first[-1] - first[0]))
+    if other[0] - queued > 0.5:
+        failures.append('chat 2 waited {:.2f} s behind chat 1'.format(other[0] - queued))
+    return failures
+
+
+CHECKS = {'coalescing': check_coalescing, 'flood': check_flood, 'chat_rate': check_chat_rate}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--checks', default=','.join(CHECKS), help=', '.join(CHECKS))
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    failed = False
+    for name in args.checks.split(','):
+        api = FakeAPI()
+        started = time.perf_counter()
+        failures = CHECKS[name](api)
+        api.shutdown()
+        api.server_close()
+        print('{:<12} {} in {:.2f} s'.format(name, 'FAILED' if failures else 'ok', time.perf_counter() - started))
+        for failure in failures:
+            print('    ' + failure)
+        failed = failed or bool(failures)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import time
+from itertools import count
+
+# 2021-01-01, 41 bits of milliseconds from it last until 2090
+EPOCH_MS = 1609459200000
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+
+def now_ms():
+    return int(time.time() * 1000) - EPOCH_MS
+
+
+class IdAllocator:
+    """Snowflake-style ids: milliseconds since EPOCH_MS, then the worker id, then a sequence number.
+
+    The milliseconds start when the allocator is created and move forward with the sequence,
+    one millisecond per 4096 ids, waiting if that would get ahead of the clock. So ids are never
+    taken from the future and a restarted process, starting at a later millisecond, can't reuse
+    them. Taking an id is a single itertools.count step, which is atomic under the GIL.
+    """
+
+    def __init__(self, worker_id=0):
+        if not 0 <= worker_id < 1 << WORKER_BITS:
+            raise ValueError('worker_id must be below {}'.format(1 << WORKER_BITS))
+        self.worker_id = worker_id
+        self._start = now_ms()
+        self._sequence = count()
+
+    def next_id(self):
+        sequence = next(self._sequence)
+        ms = self._start + (sequence >> SEQUENCE_BITS)
+        while ms > now_ms():
+            time.sleep(0.001)
+        return (ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | \
+            (sequence & ((1 << SEQUENCE_BITS) - 1))
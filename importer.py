@@ -0,0 +1,65 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+FIELDS = ('name', 'duration', 'deadline')
+MAX_TASKS = 1000
+MAX_ERRORS = 10
+
+
+def text_rows(text):
+    """Rows of a message, one task per line as in a CSV file."""
+    return numbered(csv.reader(io.StringIO(text)))
+
+
+def document_rows(buffer, file_name):
+    """Rows of an uploaded document, a CSV file or a JSON list of objects or of lists."""
+    if file_name.lower().endswith('.json'):
+        items = json.load(io.TextIOWrapper(buffer, encoding='utf-8-sig'))
+        if not isinstance(items, list):
+            raise ValueError('The JSON document must be a list of tasks')
+        return ((number, [item.get(field) for field in FIELDS] if isinstance(item, dict) else item)
+                for number, item in enumerate(items, 1))
+    return numbered(csv.reader(io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')))
+
+
+def numbered(reader):
+    """Yield (line number, fields) of a CSV reader, skipping blank lines and a header."""
+    for row in reader:
+        if not row or not any(field.strip() for field in row):
+            continue
+        if [field.strip().lower() for field in row] == list(FIELDS):
+            continue
+        yield reader.line_num, row
+
+
+def parse_tasks(rows, now):
+    """Validate every row in one pass, returning the (name, duration, deadline) of the tasks and the errors.
+
+    Deadlines are in the format of the add task dialogue, the result is in epoch seconds.
+    """
+    tasks = []
+    errors = []
+    for number, row in rows:
+        if len(tasks) + len(errors) >= MAX_TASKS:
+            errors.append('More than {} tasks, split the import'.format(MAX_TASKS))
+            break
+        try:
+            if not isinstance(row, list) or len(row) != len(FIELDS):
+                raise ValueError('expected {}'.format(', '.join(FIELDS)))
+            name, duration, deadline = (str(field).strip() if field is not None else '' for field in row)
+            if not name:
+                raise ValueError('the name is empty')
+            if not duration.isdigit() or int(duration) == 0:
+                raise ValueError('the duration must be a positive number of hours')
+            deadline = datetime.fromisoformat(deadline)
+            if deadline.tzinfo is not None:
+                raise ValueError('the deadline must be in local time, without a UTC offset')
+            if deadline <= now:
+                raise ValueError('the deadline is in the past')
+        except ValueError as error:
+            errors.append('Line {}: {}'.format(number, error))
+            continue
+        tasks.append((name, int(duration), deadline.timestamp()))
+    return tasks, errors
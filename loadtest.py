@@ -0,0 +1,130 @@
+"""Load test of the webhook server: posts synthetic updates to it on a local port.
+
+The bot runs offline in this process, the Bot API is answered by the FakeRequest of the benchmark.
+Reports the latency of the POSTs and of the updates, from their POST to the end of their dispatch.
+
+    python loadtest.py                                  # 1000 users, 8 concurrent clients
+    python loadtest.py --users 10000 --clients 32 --rounds 2
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import warnings
+from collections import defaultdict
+from datetime import datetime, timedelta
+from http.client import HTTPConnection
+from itertools import count
+from threading import Lock, Thread
+
+from telegram import Update
+from telegram.ext import ExtBot, TypeHandler
+
+import eatthefrogbot as bot
+from benchmark import FakeRequest, message_update, press_update, report, summarize
+from webhook import SECRET_TOKEN_HEADER, WebhookUpdater
+
+SECRET_TOKEN = 'loadtest'
+URL_PATH = '/loadtest'
+
+
+def user_updates(user_id, rounds, update_ids):
+    """Updates of a user adding a task and going through the menus, rounds times."""
+    deadline = (datetime.now() + timedelta(days=1)).replace(microsecond=0).isoformat(' ')
+    for _ in range(rounds):
+        yield message_update(next(update_ids), user_id, '/start')
+        for step in (bot.TASKS_MENU, bot.ADD_NEW_TASK):
+            yield press_update(next(update_ids), user_id, step)
+        for text in ('load test', '1', deadline):
+            yield message_update(next(update_ids), user_id, text)
+        for step in (bot.GET_TASK, bot.BACK_TO_TASK_MENU, bot.END):
+            yield press_update(next(update_ids), user_id, step)
+
+
+class Client(Thread):
+    """Posts the updates of its users one after the other, so that every chat sees its updates in order."""
+
+    def __init__(self, port, updates, posted):
+        super().__init__(daemon=True)
+        self.port = port
+        self.updates = updates
+        self.posted = posted
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        connection = HTTPConnection('127.0.0.1', self.port)
+        headers = {'Content-Type': 'application/json', SECRET_TOKEN_HEADER: SECRET_TOKEN}
+        for update in self.updates:
+            body = json.dumps(update)
+            started = time.perf_counter()
+            self.posted[update['update_id']] = started
+            connection.request('POST', URL_PATH, body, headers)
+            response = connection.getresponse()
+            response.read()
+            self.latencies.append(time.perf_counter() - started)
+            self.errors += response.status != 200
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=1, help='task flows of every user')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent HTTP connections')
+    parser.add_argument('--workers', type=int, default=4, help='dispatcher worker threads')
+    parser.add_argument('--port', type=int, default=18443)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    warnings.simplefilter('ignore')
+    # Every update has to go through the whole dispatch to be timed
+    os.environ['DEBOUNCE_WINDOW'] = '0'
+
+    updater = WebhookUpdater(bot=ExtBot('123:loadtest', request=FakeRequest()), workers=args.workers,
+                             use_context=True, secret_token=SECRET_TOKEN, max_queue_size=0)
+    bot.setup_dispatcher(updater, None)
+    posted = {}
+    handled = {}
+    lock = Lock()
+    total = args.users * args.rounds * 9
+
+    def done(update, context):
+        with lock:
+            handled[update.update_id] = time.perf_counter()
+
+    updater.dispatcher.add_handler(TypeHandler(Update, done), group=100)
+    updater.start_webhook(listen='127.0.0.1', port=args.port, url_path=URL_PATH,
+                          webhook_url='https://127.0.0.1:{}{}'.format(args.port, URL_PATH))
+
+    update_ids = count(1)
+    updates = defaultdict(list)
+    for user_id in range(1, args.users + 1):
+        updates[user_id % args.clients].extend(user_updates(user_id, args.rounds, update_ids))
+    clients = [Client(args.port, client_updates, posted) for client_updates in updates.values()]
+
+    started = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    while len(handled) < total and time.perf_counter() - started < 600:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    updater.stop()
+
+    latencies = {'post': [latency for client in clients for latency in client.latencies],
+                 'post_to_handled': [handled[update_id] - posted[update_id] for update_id in handled]}
+    result = summarize(latencies, elapsed, axis='webhook', scale=args.users, memory_mb=0)
+    result.update(updates=len(handled), updates_per_sec=len(handled) / elapsed)
+    report([result])
+    errors = sum(client.errors for client in clients)
+    if errors or len(handled) < total:
+        print('{} POSTs failed, {} of {} updates handled'.format(errors, len(handled), total))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import cProfile
+import io
+import logging
+import pstats
+import random
+import time
+from bisect import bisect_left
+from functools import wraps
+from heapq import heappush, heappushpop
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+
+from telegram.utils.request import Request
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TASK_COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=''):
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            cumulative += bucket_count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, cumulative))
+        lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(name, labels, self.count))
+        braces = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+        lines.append('{}_sum{} {}'.format(name, braces, self.sum))
+        lines.append('{}_count{} {}'.format(name, braces, self.count))
+        return lines
+
+
+class Registry:
+    """Metrics of the process, rendered in the Prometheus text format.
+
+    Histograms are labelled by a single label, gauges and collectors are callables evaluated on
+    every scrape, registered by name so that registering one again replaces it.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.gauges = {}
+        self.collectors = {}
+        self.slowest = []
+        self.profile_sample_rate = 0
+        self.profile_keep = 10
+        self._seq = count()
+        self._lock = Lock()
+
+    def observe(self, name, label, value, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            histograms = self.histograms.setdefault(name, {})
+            if label not in histograms:
+                histograms[label] = Histogram(buckets)
+            histograms[label].observe(value)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def collector(self, name, function):
+        """Register a function returning the Histogram rendered as name on every scrape."""
+        self.collectors[name] = function
+
+    def reset(self):
+        """Drop the recorded histograms and profiles, in a process forked from one that recorded them."""
+        with self._lock:
+            self.histograms = {}
+            self.slowest = []
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, histograms in self.histograms.items():
+                lines.append('# TYPE {} histogram'.format(name))
+                for label, histogram in histograms.items():
+                    lines.extend(histogram.render(name, '{}="{}",'.format(label[0], label[1])))
+        for name, function in self.gauges.items():
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, function()))
+        for name, function in self.collectors.items():
+            lines.append('# TYPE {} histogram'.format(name))
+            lines.extend(function().render(name))
+        return '\n'.join(lines) + '\n'
+
+    def record_profile(self, duration, name, profiler):
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(20)
+        entry = (duration, next(self._seq), name, stream.getvalue())
+        with self._lock:
+            if len(self.slowest) < self.profile_keep:
+                heappush(self.slowest, entry)
+            else:
+                heappushpop(self.slowest, entry)
+
+    def render_slowest(self):
+        with self._lock:
+            slowest = sorted(self.slowest, reverse=True)
+        return ''.join('=== {} took {:.6f}s\n{}\n'.format(name, duration, stats)
+                       for duration, _, name, stats in slowest)
+
+
+registry = Registry()
+
+
+def timed(callback, metric='handler_latency_seconds', label='handler'):
+    """Wrap a callback so that its latency is recorded, profiling a sample of the calls."""
+    name = callback.__name__
+
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        profiler = None
+        if registry.profile_sample_rate and random.random() < registry.profile_sample_rate:
+            profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            if profiler is not None:
+                return profiler.runcall(callback, *args, **kwargs)
+            return callback(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - started
+            registry.observe(metric, (label, name), duration)
+            if profiler is not None:
+                registry.record_profile(duration, name, profiler)
+
+    return wrapper
+
+
+def timed_job(callback):
+    return timed(callback, 'job_latency_seconds', 'job')
+
+
+def tasks_per_user(user_data):
+    histogram = Histogram(TASK_COUNT_BUCKETS)
+    for data in list(user_data.values()):
+        histogram.observe(len(data.get('TASKS', ())))
+    return histogram
+
+
+def instrument(conversation_handler):
+    """Record the latency of every callback of the conversation."""
+    handlers = list(conversation_handler.entry_points) + list(conversation_handler.fallbacks)
+    for state_handlers in conversation_handler.states.values():
+        handlers.extend(state_handlers)
+    for handler in handlers:
+        routes = getattr(handler, 'routes', None)
+        if routes is None:
+            handler.callback = timed(handler.callback)
+        else:
+            # A router only looks the callback up, time the callbacks it routes to
+            for key, callback in routes.items():
+                routes[key] = timed(callback)
+    return conversation_handler
+
+
+class TimedRequest(Request):
+    """Request that records the latency of every Bot API call by method."""
+
+    def post(self, url, data, timeout=None):
+        started = time.perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        finally:
+            registry.observe('bot_api_latency_seconds', ('method', url.rsplit('/', 1)[-1]),
+                             time.perf_counter() - started)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = registry.render()
+        elif self.path == '/slowest':
+            body = registry.render_slowest()
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on http://%s:%d/metrics', host, port)
+    return server
@@ -0,0 +1,302 @@
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import time
+from collections import defaultdict
+from threading import Lock
+
+from telegram.ext import BasePersistence, ConversationHandler, PicklePersistence
+from telegram.ext.utils.promise import Promise
+
+from tasks import Task, TaskStore
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    user_id INTEGER NOT NULL,
+    task_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    duration INTEGER,
+    deadline REAL,
+    state TEXT NOT NULL,
+    started_at REAL,
+    ends_at REAL,
+    PRIMARY KEY (user_id, task_id)
+);
+CREATE INDEX IF NOT EXISTS tasks_state_deadline ON tasks (state, deadline);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT,
+    PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+
+def resolve_state(state):
+    """(state to store, whether it is final) of a conversation state handed over by PTB.
+
+    While a run_async handler runs, PTB hands over (old state, Promise) pairs, nested at times.
+    A finished handler gives its result, a running one the old state for now.
+    """
+    final = True
+    while isinstance(state, tuple) and len(state) == 2 and isinstance(state[1], Promise):
+        old_state, promise = state
+        result = None
+        if promise.done.is_set():
+            try:
+                result = promise.result(0)
+            except Exception:
+                # The conversation stays in its old state, as ConversationHandler does
+                pass
+        else:
+            final = False
+        state = old_state if result is None else result
+    return (None if state == ConversationHandler.END else state), final
+
+
+class LazyUserData(defaultdict):
+    """user_data loading the data of a user on first access.
+
+    load_users(user_ids) returns the data of the stored ones among user_ids by user id.
+    """
+
+    def __init__(self, load_users):
+        super().__init__(dict)
+        self._load_users = load_users
+        self._lock = Lock()
+
+    def __missing__(self, user_id):
+        data = self._load_users([user_id]).get(user_id, {})
+        with self._lock:
+            # Loaded by another thread meanwhile
+            return self.setdefault(user_id, data)
+
+    def load(self, user_ids, chunk=500):
+        """Load the users not loaded yet, chunk users per query."""
+        user_ids = [user_id for user_id in user_ids if user_id not in self]
+        for start in range(0, len(user_ids), chunk):
+            loaded = self._load_users(user_ids[start:start + chunk])
+            with self._lock:
+                for user_id, data in loaded.items():
+                    self.setdefault(user_id, data)
+
+
+class _LiveData:
+    """User data never holds Bot instances, so hand it over as is.
+
+    PTB deep copies the data of the current user on every update to swap Bot instances out,
+    which costs O(tasks) per update. Writes are batched and serialized in flush() instead.
+    """
+
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    def insert_bot(self, obj):
+        return obj
+
+    def close(self, flushed_at=None):
+        pass
+
+
+class FilePersistence(_LiveData, PicklePersistence):
+    """Single pickle file that is only written on flush(), atomically via a temporary file.
+
+    flushed_at is the time of the last flush of the previous run, the file being rewritten on every flush.
+    flush(flushed_at) dates the file back to flushed_at, to carry the time over to a new file.
+    """
+
+    def __init__(self, filename):
+        super().__init__(filename, store_chat_data=False, store_bot_data=False, on_flush=True)
+        self.flushed_at = os.path.getmtime(filename) if os.path.exists(filename) else None
+
+    def _dump_singlefile(self):
+        conversations = {name: {key: resolve_state(state)[0] for key, state in states.items()}
+                         for name, states in (self.conversations or {}).items()}
+        data = pickle.dumps({
+            'conversations': conversations,
+            'user_data': self.user_data or {},
+            'chat_data': self.chat_data or {},
+            'bot_data': self.bot_data or {},
+            'callback_data': self.callback_data,
+        })
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, self.filename)
+
+    def flush(self, flushed_at=None):
+        try:
+            super().flush()
+        except RuntimeError:
+            # The data changed while being pickled, it will be written on the next flush
+            logger.warning('User data changed during flush, retrying later')
+        if flushed_at is not None and os.path.exists(self.filename):
+            os.utime(self.filename, (flushed_at, flushed_at))
+
+
+class SQLitePersistence(_LiveData, BasePersistence):
+    """SQLite database in WAL mode with one plain row per task.
+
+    Updates only mark users and conversations as dirty, flush() writes all of them in one
+    transaction, so handlers never wait for the disk. Every flush also stores its time, flushed_at
+    is the time of the last flush of the previous run, flush(flushed_at) stores the given time instead.
+    A lazy persistence loads users on first access.
+    """
+
+    def __init__(self, filename, lazy=False):
+        super().__init__(store_chat_data=False, store_bot_data=False)
+        self.lazy = lazy
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'flushed_at'").fetchone()
+        self.flushed_at = row and row[0]
+        self._lock = Lock()
+        # Guards the dirty entries only, so that handlers marking them never wait for a flush writing
+        self._dirty_lock = Lock()
+        self._dirty_users = {}
+        self._dirty_conversations = {}
+        self._conversations = {}
+
+    def get_user_data(self):
+        if self.lazy:
+            return LazyUserData(self._load_users)
+        user_data = defaultdict(dict)
+        tasks = defaultdict(list)
+        with self._lock:
+            for user_id, data in self.connection.execute('SELECT user_id, data FROM user_data'):
+                user_data[user_id] = pickle.loads(data)
+            rows = self.connection.execute('SELECT user_id, task_id, name, duration, deadline, state, started_at, '
+                                           'ends_at FROM tasks')
+            for user_id, *task in rows:
+                tasks[user_id].append(Task(*task))
+        for user_id, user_tasks in tasks.items():
+            user_data[user_id]['TASKS'] = TaskStore()
+            user_data[user_id]['TASKS'].add_many(user_tasks)
+        return user_data
+
+    def user_ids(self, state=None):
+        """Ids of the stored users, only of the ones with tasks in state if given."""
+        with self._lock:
+            if state is None:
+                rows = self.connection.execute('SELECT user_id FROM user_data').fetchall()
+            else:
+                rows = self.connection.execute('SELECT DISTINCT user_id FROM tasks WHERE state = ?',
+                                               (state,)).fetchall()
+        return [user_id for user_id, in rows]
+
+    def _load_users(self, user_ids):
+        placeholders = ', '.join('?' * len(user_ids))
+        with self._lock:
+            rows = self.connection.execute('SELECT user_id, data FROM user_data WHERE user_id IN ({})'
+                                           .format(placeholders), user_ids).fetchall()
+            task_rows = self.connection.execute('SELECT user_id, task_id, name, duration, deadline, state, started_at, '
+                                                'ends_at FROM tasks WHERE user_id IN ({})'.format(placeholders),
+                                                user_ids).fetchall()
+        user_data = {user_id: pickle.loads(data) for user_id, data in rows}
+        tasks = defaultdict(list)
+        for user_id, *task in task_rows:
+            tasks[user_id].append(Task(*task))
+        for user_id, user_tasks in tasks.items():
+            user_data.setdefault(user_id, {})['TASKS'] = TaskStore()
+            user_data[user_id]['TASKS'].add_many(user_tasks)
+        return user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        if name not in self._conversations:
+            with self._lock:
+                rows = self.connection.execute('SELECT key, state FROM conversations WHERE name = ?', (name,))
+                self._conversations[name] = {tuple(json.loads(key)): state for key, state in rows}
+        return self._conversations[name].copy()
+
+    def update_conversation(self, name, key, new_state):
+        with self._dirty_lock:
+            if self._conversations.setdefault(name, {}).get(key) == new_state:
+                return
+            self._conversations[name][key] = new_state
+            self._dirty_conversations[(name, key)] = new_state
+
+    def update_user_data(self, user_id, data):
+        with self._dirty_lock:
+            self._dirty_users[user_id] = data
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush(self, flushed_at=None):
+        with self._lock:
+            with self._dirty_lock:
+                users, self._dirty_users = self._dirty_users, {}
+                conversations, self._dirty_conversations = self._dirty_conversations, {}
+            try:
+                rows = []
+                pending = {}
+                for (name, key), state in conversations.items():
+                    state, final = resolve_state(state)
+                    rows.append((name, json.dumps(key), state))
+                    if not final:
+                        # Written again once the handler is done
+                        pending[(name, key)] = conversations[(name, key)]
+                with self.connection:
+                    for user_id, data in users.items():
+                        self._write_user(user_id, data)
+                    self.connection.executemany(
+                        'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)', rows)
+                    self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('flushed_at', ?)",
+                                            (flushed_at or time.time(),))
+            except (RuntimeError, sqlite3.Error):
+                # Handlers may change the data being written, anything left is written on the next flush
+                logger.exception('Flush failed, retrying later')
+                self._mark_dirty(users, conversations)
+            else:
+                self._mark_dirty({}, pending)
+
+    def _mark_dirty(self, users, conversations):
+        """Mark entries taken by a flush as dirty again, unless they were updated since."""
+        with self._dirty_lock:
+            for user_id, data in users.items():
+                self._dirty_users.setdefault(user_id, data)
+            for key, state in conversations.items():
+                self._dirty_conversations.setdefault(key, state)
+
+    def close(self, flushed_at=None):
+        self.flush(flushed_at)
+        self.connection.close()
+
+    def _write_user(self, user_id, data):
+        data = dict(data)
+        tasks = list(data.pop('TASKS', ()))
+        self.connection.execute('INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)',
+                                (user_id, pickle.dumps(data)))
+        self.connection.execute('DELETE FROM tasks WHERE user_id = ?', (user_id,))
+        self.connection.executemany(
+            'INSERT INTO tasks (user_id, task_id, name, duration, deadline, state, started_at, ends_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(user_id, task.id, task.name, task.duration, task.deadline, task.state, task.started_at, task.ends_at)
+             for task in tasks]
+        )
@@ -0,0 +1,100 @@
+from bisect import bisect_left, insort
+
+BLOCK = 64
+
+
+class Plan:
+    """Earliest-deadline-first plan of tasks done one after another, kept up to date incrementally.
+
+    Entries are (deadline, task id, work seconds) sorted by deadline, in blocks of up to
+    2 * BLOCK entries. Every block keeps the total work of its entries and its slack: the minimum
+    of deadline - work done up to and including the entry, counted from the start of the block.
+    An update only recomputes one block and checking the whole plan only walks the blocks, so
+    both stay in the microseconds for thousands of tasks.
+    """
+
+    def __init__(self):
+        self._blocks = []
+        self._keys = []
+        self._work = []
+        self._slack = []
+
+    def __len__(self):
+        return sum(len(block) for block in self._blocks)
+
+    def add(self, deadline, task_id, work):
+        entry = (deadline, task_id, work)
+        if not self._blocks:
+            self._blocks.append([entry])
+            self._keys.append(entry[:2])
+            self._work.append(0)
+            self._slack.append(0)
+            self._update(0)
+            return
+        i = min(bisect_left(self._keys, entry[:2]), len(self._blocks) - 1)
+        insort(self._blocks[i], entry)
+        if len(self._blocks[i]) > 2 * BLOCK:
+            block = self._blocks[i]
+            self._blocks[i:i + 1] = [block[:BLOCK], block[BLOCK:]]
+            self._keys[i:i + 1] = [None, None]
+            self._work[i:i + 1] = [0, 0]
+            self._slack[i:i + 1] = [0, 0]
+            self._update(i + 1)
+        self._update(i)
+
+    def add_many(self, entries):
+        """Add entries in one batch, rebuilding the blocks from a single sort."""
+        entries = sorted([entry for block in self._blocks for entry in block] + list(entries))
+        self._blocks = [entries[i:i + BLOCK] for i in range(0, len(entries), BLOCK)]
+        self._keys = [None] * len(self._blocks)
+        self._work = [0] * len(self._blocks)
+        self._slack = [0] * len(self._blocks)
+        for i in range(len(self._blocks)):
+            self._update(i)
+
+    def remove(self, deadline, task_id):
+        i = bisect_left(self._keys, (deadline, task_id))
+        if i == len(self._blocks):
+            return
+        block = self._blocks[i]
+        j = bisect_left(block, (deadline, task_id))
+        if j == len(block) or block[j][:2] != (deadline, task_id):
+            return
+        del block[j]
+        if block:
+            self._update(i)
+        else:
+            del self._blocks[i], self._keys[i], self._work[i], self._slack[i]
+
+    def first(self):
+        """Task id of the first planned task, None if there are no tasks."""
+        return self._blocks[0][0][1] if self._blocks else None
+
+    def first_late(self, start):
+        """(task id, seconds late) of the first task missing its deadline when work begins at start."""
+        for i, block in enumerate(self._blocks):
+            if self._slack[i] < start:
+                for deadline, task_id, work in block:
+                    start += work
+                    if start > deadline:
+                        return task_id, start - deadline
+            start += self._work[i]
+        return None
+
+    def schedule(self, start):
+        """Lazily yield (task id, start, end) of the planned tasks, one after another from start."""
+        for block in self._blocks:
+            for _, task_id, work in block:
+                yield task_id, start, start + work
+                start += work
+
+    def _update(self, i):
+        block = self._blocks[i]
+        done = 0
+        slack = float('inf')
+        for deadline, _, work in block:
+            done += work
+            slack = min(slack, deadline - done)
+        self._keys[i] = block[-1][:2]
+        self._work[i] = done
+        self._slack[i] = slack
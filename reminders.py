@@ -0,0 +1,79 @@
+import logging
+import time
+from heapq import heapify, heappop, heappush
+from itertools import count
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class ReminderScheduler:
+    """All pending reminders of the bot in one min-heap keyed by fire time.
+
+    Fire times are epoch seconds. A reminder is identified by (chat id, task id, callback), so tasks with the same name never
+    collide. Heap entries are plain tuples; cancelling only drops the key from the pending map
+    and the stale entry is skipped when it reaches the top of the heap. A single repeating job
+    calls tick(), which fires every reminder that is due as callback(chat_id, task_name).
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._pending = {}
+        self._seq = count()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def schedule(self, chat_id, task, callback, when):
+        entry = self._entry(chat_id, task, callback, when)
+        with self._lock:
+            self._pending[entry[2]] = entry
+            heappush(self._heap, entry)
+            self._compact()
+
+    def schedule_many(self, reminders):
+        """Bulk insert of (chat_id, task, callback, when) tuples with a single heapify."""
+        with self._lock:
+            for reminder in reminders:
+                entry = self._entry(*reminder)
+                self._pending[entry[2]] = entry
+                self._heap.append(entry)
+            heapify(self._heap)
+            self._compact()
+
+    def cancel(self, chat_id, task_id, *callbacks):
+        with self._lock:
+            cancelled = [self._pending.pop((chat_id, task_id, callback), None) for callback in callbacks]
+        return any(entry is not None for entry in cancelled)
+
+    def is_scheduled(self, chat_id, task_id, callback):
+        return (chat_id, task_id, callback) in self._pending
+
+    def due(self, now=None):
+        """Pop and return the (chat_id, task_id, callback, task_name) reminders due by now."""
+        now = time.time() if now is None else now
+        fired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                entry = heappop(self._heap)
+                if self._pending.get(entry[2]) is entry:
+                    del self._pending[entry[2]]
+                    fired.append(entry[2] + (entry[3],))
+        return fired
+
+    def tick(self, context):
+        for chat_id, _, callback, task_name in self.due():
+            try:
+                callback(chat_id, task_name)
+            except Exception:
+                logger.exception('Failed to send a reminder to chat %s', chat_id)
+
+    def _entry(self, chat_id, task, callback, when):
+        return when, next(self._seq), (chat_id, task.id, callback), task.name
+
+    def _compact(self):
+        # Drop cancelled entries once they make up most of the heap
+        if len(self._heap) > 2 * len(self._pending) + 64:
+            self._heap = [entry for entry in self._heap if self._pending.get(entry[2]) is entry]
+            heapify(self._heap)
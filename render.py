@@ -0,0 +1,42 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class RenderCache:
+    """LRU cache of rendered task views, keyed by task id and checked against the task version.
+
+    A task's version changes whenever it is mutated, so a stale entry is never returned even if
+    a handler forgets to invalidate it; invalidate() just frees the memory right away.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, task, render, *args):
+        """The view render(task, *args) of the task, rendered again when the version or args changed."""
+        stamp = (task.version,) + args
+        with self._lock:
+            entry = self._entries.get(task.id)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(task.id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = render(task, *args)
+        with self._lock:
+            self._entries[task.id] = (stamp, value)
+            self._entries.move_to_end(task.id)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, task_id):
+        with self._lock:
+            self._entries.pop(task_id, None)
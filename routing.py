@@ -0,0 +1,47 @@
+from telegram import Update
+from telegram.ext import Handler
+
+
+def encode(opcode, number):
+    """Compact callback_data: a one character opcode, then the number in hexadecimal."""
+    return '{}{:x}'.format(opcode, number)
+
+
+def decode(data):
+    """(opcode, number) of callback_data built by encode, None for any other data."""
+    try:
+        return data[0], int(data[1:], 16)
+    except (IndexError, ValueError):
+        return None
+
+
+class CallbackRouter(Handler):
+    """Handler of all the buttons of a conversation state, routing with a dict lookup instead of a regex each.
+
+    routes maps the callback_data of plain buttons and the opcodes of encoded ones to their
+    callback. The data is decoded once here: callbacks find the opcode, or the plain data, in
+    context.opcode and the number in context.number.
+    """
+
+    def __init__(self, routes, run_async=False):
+        super().__init__(self.route, run_async=run_async)
+        self.routes = routes
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or update.callback_query is None or not update.callback_query.data:
+            return None
+        data = update.callback_query.data
+        callback = self.routes.get(data)
+        if callback is not None:
+            return callback, data, None
+        decoded = decode(data)
+        if decoded is None or decoded[0] not in self.routes:
+            return None
+        return self.routes[decoded[0]], decoded[0], decoded[1]
+
+    def collect_additional_context(self, context, update, dispatcher, check_result):
+        context.routed, context.opcode, context.number = check_result
+
+    @staticmethod
+    def route(update, context):
+        return context.routed(update, context)
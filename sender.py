@@ -0,0 +1,184 @@
+import logging
+import time
+from collections import deque
+from heapq import heappop, heappush, heapreplace
+from itertools import count
+from threading import Condition, Thread
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available."""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        self._refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundQueue:
+    """Queue for the messages the bot sends on its own, like reminders.
+
+    A worker thread sends queued messages within a global and a per-chat token bucket (Telegram
+    allows about 30 messages per second overall and one per second per chat). Identical pending
+    messages to the same chat are sent once. RetryAfter pauses delivery for the requested time,
+    network errors are retried with exponential backoff.
+    """
+
+    def __init__(self, rate=25, chat_rate=1, chat_burst=3, max_retries=5):
+        self.bot = None
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate, rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets = {}
+        self._chats = {}
+        self._ready = []
+        self._seq = count()
+        self._condition = Condition()
+        self._running = False
+        self._thread = None
+        self.counters = {'queued': 0, 'sent': 0, 'coalesced': 0, 'retried': 0, 'failed': 0}
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    @property
+    def depth(self):
+        return sum(len(messages) for messages in list(self._chats.values()))
+
+    def start(self, bot):
+        self.bot = bot
+        self._running = True
+        self._thread = Thread(target=self._run, name='outbound_queue', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stop after sending what is queued, waiting at most timeout seconds."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self._condition:
+            messages = self._chats.get(chat_id)
+            if messages is None:
+                messages = self._chats[chat_id] = deque()
+                now = time.monotonic()
+                bucket = self._chat_buckets.get(chat_id)
+                self._push(now + (bucket.delay(now) if bucket else 0), chat_id)
+            elif any(message[0] == text for message in messages):
+                self.counters['coalesced'] += 1
+                return
+            messages.append((text, kwargs, time.monotonic(), 0))
+            self.counters['queued'] += 1
+            self._condition.notify()
+
+    def _push(self, ready_at, chat_id):
+        heappush(self._ready, (ready_at, next(self._seq), chat_id))
+
+    def _next(self):
+        """Wait for the next message that may be sent, None once stopped and drained."""
+        with self._condition:
+            while True:
+                if not self._ready:
+                    if not self._running:
+                        return None
+                    self._condition.wait()
+                    continue
+                now = time.monotonic()
+                ready_at, _, chat_id = self._ready[0]
+                bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self._chat_rate, self._chat_burst))
+                chat_wait = bucket.delay(now)
+                if ready_at <= now and chat_wait > 0:
+                    # Only this chat has to wait, the chats behind it go first
+                    heapreplace(self._ready, (now + chat_wait, next(self._seq), chat_id))
+                    continue
+                wait = max(ready_at - now, self._bucket.delay(now))
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                heappop(self._ready)
+                self._bucket.consume(now)
+                bucket.consume(now)
+                return chat_id, self._chats[chat_id].popleft()
+
+    def _done(self, chat_id, message, retry_in=None):
+        with self._condition:
+            messages = self._chats[chat_id]
+            if retry_in is not None:
+                messages.appendleft(message)
+            if not messages:
+                del self._chats[chat_id]
+                self._prune()
+                return
+            now = time.monotonic()
+            self._push(now + (retry_in or self._chat_buckets[chat_id].delay(now)), chat_id)
+
+    def _prune(self):
+        now = time.monotonic()
+        if len(self._chat_buckets) > 2 * len(self._chats) + 1024:
+            self._chat_buckets = {chat_id: bucket for chat_id, bucket in self._chat_buckets.items()
+                                  if chat_id in self._chats or not bucket.is_full(now)}
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            chat_id, message = item
+            text, kwargs, queued_at, attempts = message
+            try:
+                self.bot.send_message(chat_id, text=text, **kwargs)
+            except RetryAfter as error:
+                logger.warning('Flood limit hit, retrying in %s seconds', error.retry_after)
+                with self._condition:
+                    self._bucket.pause(time.monotonic(), error.retry_after)
+                self.counters['retried'] += 1
+                self._done(chat_id, message, retry_in=error.retry_after)
+            except BadRequest as error:
+                logger.error('Failed to send a message to chat %s: %s', chat_id, error)
+                self.counters['failed'] += 1
+                self._done(chat_id, message)
+            except NetworkError as error:
+                if attempts + 1 >= self.max_retries:
+                    logger.error('Giving up on a message to chat %s: %s', chat_id, error)
+                    self.counters['failed'] += 1
+                    self._done(chat_id, message)
+                else:
+                    self.counters['retried'] += 1
+                    self._done(chat_id, (text, kwargs, queued_at, attempts + 1), retry_in=2 ** attempts)
+            except Exception:
+                logger.exception('Failed to send a message to chat %s', chat_id)
+                self.counters['failed'] += 1
+                self._done(chat_id, message)
+            else:
+                latency = time.monotonic() - queued_at
+                self.counters['sent'] += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                self._done(chat_id, message)
@@ -0,0 +1,147 @@
+import json
+import logging
+import multiprocessing
+import os
+import re
+import signal
+from glob import glob
+from threading import Event, Thread
+
+from telegram import Update
+
+from eventlog import load, log_paths, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(chat_id, shards):
+    return chat_id % shards
+
+
+def shard_path(path, index, shards):
+    if shards == 1:
+        return path
+    return '{}.{}-of-{}'.format(path, index, shards)
+
+
+class ShardRouter:
+    """Update callback of the front process, forwards each update to the worker owning its chat.
+
+    The front dispatcher handles updates one at a time and every chat always maps to the same
+    queue, so the updates of a chat reach their worker in order.
+    """
+
+    def __init__(self, queues):
+        self.queues = queues
+
+    def __call__(self, update, context):
+        chat = update.effective_chat
+        self.queues[shard_of(chat.id if chat else 0, len(self.queues))].put(update.to_json())
+
+
+def start_workers(target, shards, queue_size):
+    queues = [multiprocessing.Queue(queue_size) for _ in range(shards)]
+    processes = [multiprocessing.Process(target=target, args=(index, shards, queue), name='shard-{}'.format(index))
+                 for index, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+    return processes, queues
+
+
+def stop_workers(processes, queues):
+    """Let every worker drain its queue, flush its persistence and exit."""
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        process.join()
+
+
+def serve(updater, queue):
+    """Worker loop: process the updates routed to this shard until the front process stops."""
+    # Shutdown is driven by the front process, which waits for the queue to be drained
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    dispatcher = updater.dispatcher
+    updater.job_queue.start()
+    # Updates are processed here in order, the dispatcher only runs the worker threads of run_async handlers
+    ready = Event()
+    Thread(target=dispatcher.start, kwargs={'ready': ready}, name='dispatcher').start()
+    ready.wait()
+    while True:
+        data = queue.get()
+        if data is None:
+            break
+        dispatcher.process_update(Update.de_json(json.loads(data), updater.bot))
+    dispatcher.stop()
+    updater.job_queue.stop()
+    if dispatcher.persistence:
+        dispatcher.update_persistence()
+        dispatcher.persistence.flush()
+
+
+def rebalance(create_persistence, path, shards, conversation_name):
+    """Move users and conversations to the shard owning them after the number of shards changed.
+
+    The new shards keep the last flush time of the old ones, restored reminders due before it
+    were sent by the previous run and the ones due later are still to be sent.
+    """
+    current = {shard_path(path, index, shards) for index in range(shards)}
+    old = [filename for filename in [path] + glob(path + '.*-of-*')
+           if filename not in current and os.path.exists(filename)
+           and (filename == path or re.search(r'\.\d+-of-\d+$', filename))]
+    if not old:
+        return
+    logger.info('Rebalancing %s into %d shards', ', '.join(old), shards)
+
+    new = [create_persistence(shard_path(path, index, shards)) for index in range(shards)]
+    flushed_at = [persistence.flushed_at for persistence in new]
+    for filename in old:
+        persistence = create_persistence(filename)
+        flushed_at.append(persistence.flushed_at)
+        for user_id, data in persistence.get_user_data().items():
+            new[shard_of(user_id, shards)].update_user_data(user_id, data)
+        for key, state in persistence.get_conversations(conversation_name).items():
+            new[shard_of(key[0], shards)].update_conversation(conversation_name, key, state)
+        persistence.close()
+    flushed_at = max(filter(None, flushed_at), default=None)
+    for persistence in new:
+        persistence.flush(flushed_at)
+        persistence.close(flushed_at)
+    # Only drop the old shards once everything is stored in the new ones
+    for filename in old:
+        for leftover in (filename, filename + '-wal', filename + '-shm'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def rebalance_events(path, shards):
+    """Move the task events of every user to the event log of the shard owning them after the number of shards changed.
+
+    The tasks of every shard are written as a fresh snapshot, the old logs are dropped once all the
+    snapshots are written.
+    """
+    current = [shard_path(path, index, shards) for index in range(shards)]
+    bases = {re.sub(r'\.(snapshot|old)$', '', filename) for filename in glob(path + '.*-of-*')}
+    old = [base for base in [path] + sorted(bases)
+           if base not in current and (base == path or re.search(r'\.\d+-of-\d+$', base))
+           and any(os.path.exists(filename) for filename in log_paths(base))]
+    if not old:
+        return
+    logger.info('Rebalancing %s into %d shards', ', '.join(old), shards)
+
+    # Shards left by an interrupted rebalance keep the users the old logs do not have
+    stores = [load(*log_paths(filename)) for filename in current]
+    for filename in old:
+        for user_id, tasks in load(*log_paths(filename)).items():
+            stores[shard_of(user_id, shards)][user_id] = tasks
+    for filename, shard_stores in zip(current, stores):
+        snapshot, old_log, log = log_paths(filename)
+        write_snapshot(snapshot, shard_stores)
+        for leftover in (old_log, log):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    for filename in old:
+        for leftover in log_paths(filename):
+            if os.path.exists(leftover):
+                os.remove(leftover)
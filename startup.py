@@ -0,0 +1,36 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """Wall clock of the startup phases of a process, up to its first update.
+
+    Every mark closes the phase opened by the previous one. Registered as an update callback, the
+    timer marks the first update and logs the phases once.
+    """
+
+    def __init__(self, started=None):
+        self.started = time.perf_counter() if started is None else started
+        self.phases = {}
+        self._last = self.started
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    @property
+    def elapsed(self):
+        """Seconds from the start to the last mark."""
+        return self._last - self.started
+
+    def summary(self):
+        return ', '.join('{} {:.1f} ms'.format(phase, seconds * 1000) for phase, seconds in self.phases.items())
+
+    def __call__(self, update, context):
+        if 'first_update' in self.phases:
+            return
+        self.mark('first_update')
+        logger.info('First update %.1f ms after start: %s', self.elapsed * 1000, self.summary())
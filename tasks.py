@@ -0,0 +1,198 @@
+from bisect import bisect_left, insort
+from heapq import merge
+from itertools import islice
+
+from planner import Plan
+
+NEW = 'NEW'
+IN_PROGRESS = 'IN_PROGRESS'
+DONE = 'DONE'
+STATES = (NEW, IN_PROGRESS, DONE)
+
+
+class Task:
+    """A task of a user.
+
+    All times are epoch seconds: deadline, started_at (when the task was started) and ends_at
+    (when the time given to the task runs out, never after the deadline).
+    Slots keep the per-task memory down to the attributes themselves.
+    """
+
+    __slots__ = ('id', 'name', 'duration', 'deadline', 'state', 'started_at', 'ends_at', 'version')
+
+    def __init__(self, id, name, duration, deadline, state, started_at=None, ends_at=None):
+        self.id = id
+        self.name = name
+        self.duration = duration
+        self.deadline = deadline
+        self.state = state
+        self.started_at = started_at
+        self.ends_at = ends_at
+        # Bumped by TaskStore on every change, cached renderings of the task are checked against it
+        self.version = 0
+
+
+class TaskStore:
+    """Tasks of a single user with O(1) lookup by id.
+
+    Besides the id map, the store keeps the ids of every state and, per state, a list of
+    (deadline, id) pairs sorted by deadline, so listings never have to scan or sort all tasks.
+    Tasks without a deadline yet are only present in the id and state indexes.
+    New tasks are also kept in an earliest-deadline-first plan, updated along with the indexes.
+    The sorted ids give every task its number shown to the user, ids growing in creation order.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self._ids = []
+        self._by_state = {state: set() for state in STATES}
+        self._by_deadline = {state: [] for state in STATES}
+        self._plan = Plan()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Stores pickled before the plan existed
+        if '_plan' not in state:
+            self._plan = Plan()
+            self._plan.add_many(filter(None, map(planned, self._tasks.values())))
+        if '_ids' not in state:
+            self._ids = sorted(self._tasks)
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __iter__(self):
+        return iter(self._tasks.values())
+
+    def __contains__(self, task_id):
+        return task_id in self._tasks
+
+    def get(self, task_id):
+        return self._tasks.get(task_id)
+
+    def add(self, task):
+        if task.id not in self._tasks:
+            insort(self._ids, task.id)
+        self._tasks[task.id] = task
+        self._index(task)
+
+    def add_many(self, tasks):
+        """Add tasks in one batch, sorting every touched deadline index once instead of per task."""
+        touched = set()
+        entries = []
+        ids = []
+        for task in tasks:
+            if task.id not in self._tasks:
+                ids.append(task.id)
+            self._tasks[task.id] = task
+            self._by_state[task.state].add(task.id)
+            if task.deadline is not None:
+                self._by_deadline[task.state].append((task.deadline, task.id))
+                touched.add(task.state)
+            entry = planned(task)
+            if entry:
+                entries.append(entry)
+        for state in touched:
+            self._by_deadline[state].sort()
+        if ids:
+            self._ids.extend(ids)
+            self._ids.sort()
+        if entries:
+            self._plan.add_many(entries)
+
+    def remove(self, task_id):
+        task = self._tasks.pop(task_id, None)
+        if task is not None:
+            del self._ids[bisect_left(self._ids, task_id)]
+            self._unindex(task)
+        return task
+
+    def number(self, task):
+        """Number of the task among the tasks of the user, from 1 for the oldest one."""
+        return bisect_left(self._ids, task.id) + 1
+
+    def set_state(self, task, state):
+        self._unindex(task)
+        task.state = state
+        self._index(task)
+        self.touch(task)
+
+    def set_deadline(self, task, deadline):
+        self._unindex(task)
+        task.deadline = deadline
+        self._index(task)
+        self.touch(task)
+
+    def touch(self, task):
+        task.version += 1
+
+    def has_state(self, state):
+        return bool(self._by_state[state])
+
+    def count(self, state):
+        return len(self._by_state[state])
+
+    def by_deadline(self, *states):
+        """Lazily yield tasks of the given states (all by default) ordered by deadline."""
+        lists = [self._by_deadline[state] for state in (states or STATES)]
+        for _, task_id in merge(*lists):
+            yield self._tasks[task_id]
+
+    def count_with_deadline(self, *states):
+        return sum(len(self._by_deadline[state]) for state in (states or STATES))
+
+    def page(self, offset, limit, *states):
+        """Return up to limit tasks from offset in deadline order, and whether more tasks follow."""
+        if len(states) == 1:
+            entries = self._by_deadline[states[0]][offset:offset + limit + 1]
+            tasks = [self._tasks[task_id] for _, task_id in entries]
+        else:
+            tasks = list(islice(self.by_deadline(*states), offset, offset + limit + 1))
+        return tasks[:limit], len(tasks) > limit
+
+    def plan_start(self, now):
+        """When work on the new tasks can begin, after the time left of the task in progress."""
+        return max([now] + [self._tasks[task_id].ends_at for task_id in self._by_state[IN_PROGRESS]
+                            if self._tasks[task_id].ends_at is not None])
+
+    def next_frog(self):
+        """The task to do now: the one in progress, or else the first one of the plan."""
+        for task_id in self._by_state[IN_PROGRESS]:
+            return self._tasks[task_id]
+        first = self._plan.first()
+        return None if first is None else self._tasks[first]
+
+    def first_late(self, now):
+        """(task, seconds late) of the first new task the plan can't fit before its deadline, or None."""
+        late = self._plan.first_late(self.plan_start(now))
+        return None if late is None else (self._tasks[late[0]], late[1])
+
+    def schedule(self, now, limit):
+        """The first limit new tasks of the plan as (task, start, end)."""
+        return [(self._tasks[task_id], start, end)
+                for task_id, start, end in islice(self._plan.schedule(self.plan_start(now)), limit)]
+
+    def _index(self, task):
+        self._by_state[task.state].add(task.id)
+        if task.deadline is not None:
+            insort(self._by_deadline[task.state], (task.deadline, task.id))
+        entry = planned(task)
+        if entry:
+            self._plan.add(*entry)
+
+    def _unindex(self, task):
+        self._by_state[task.state].discard(task.id)
+        if planned(task):
+            self._plan.remove(task.deadline, task.id)
+        if task.deadline is not None:
+            entries = self._by_deadline[task.state]
+            i = bisect_left(entries, (task.deadline, task.id))
+            if i < len(entries) and entries[i][1] == task.id:
+                del entries[i]
+
+
+def planned(task):
+    """Plan entry of a new task, None for tasks that are started, done or incomplete."""
+    if task.state != NEW or task.deadline is None or task.duration is None:
+        return None
+    return task.deadline, task.id, task.duration * 3600
@@ -0,0 +1,49 @@
+import time
+
+from telegram.constants import MAX_MESSAGE_LENGTH
+
+from eatthefrogbot import DIGEST_SECTION_LINES, build_digest
+from tasks import IN_PROGRESS, NEW, Task, TaskStore
+
+HOUR = 3600
+
+
+def make_tasks(count, now, name='task'):
+    tasks = TaskStore()
+    # Half overdue, half due within the next day
+    tasks.add_many(Task(i, '{} {}'.format(name, i), 1, now + (i - count // 2) * 60 + 30, NEW) for i in range(count))
+    return tasks
+
+
+def test_digest_of_many_tasks_fits_in_a_message():
+    now = time.time()
+    text = build_digest(make_tasks(300, now, name='a very long task name ' * 20), now, 24 * HOUR)
+    assert len(text) <= MAX_MESSAGE_LENGTH
+    assert text.count('…and {} more'.format(150 - DIGEST_SECTION_LINES)) == 2
+
+
+def test_digest_lists_the_first_tasks_by_deadline():
+    now = time.time()
+    text = build_digest(make_tasks(300, now), now, 24 * HOUR)
+    assert 'task 0: the deadline has passed' in text
+    assert 'task {}: the deadline'.format(DIGEST_SECTION_LINES) not in text
+    assert 'task 150: deadline' in text
+
+
+def test_digest_puts_the_task_out_of_time_first():
+    now = time.time()
+    tasks = make_tasks(300, now)
+    task = Task(1000, 'frog', 1, now + HOUR, NEW)
+    tasks.add(task)
+    tasks.set_state(task, IN_PROGRESS)
+    task.started_at, task.ends_at = now - 2 * HOUR, now - HOUR
+    text = build_digest(tasks, now, 24 * HOUR)
+    assert text.split('\n')[3] == 'frog: the time for it has run out, finish or extend it'
+    assert '…and {} more'.format(151 - DIGEST_SECTION_LINES) in text
+
+
+def test_no_digest_without_tasks_due():
+    now = time.time()
+    tasks = TaskStore()
+    tasks.add(Task(1, 'later', 1, now + 48 * HOUR, NEW))
+    assert build_digest(tasks, now, 24 * HOUR) is None
@@ -0,0 +1,101 @@
+import os
+
+from eventlog import ADDED, EXTENDED, FINISHED, STARTED, EventLog, encode, load
+from tasks import DONE, IN_PROGRESS, NEW, Task
+
+
+def snapshot(stores):
+    return {user_id: sorted((task.id, task.name, task.duration, task.deadline, task.state, task.started_at,
+                             task.ends_at) for task in tasks)
+            for user_id, tasks in stores.items()}
+
+
+def fill(log):
+    """Record a history of events, returning the tasks they leave."""
+    tasks = {1: {}, 2: {}}
+    for user_id in tasks:
+        for task_id in range(1, 6):
+            task = Task(task_id, 'task {} ü'.format(task_id), task_id, 1e9 + task_id, NEW)
+            log.record(ADDED, user_id, task)
+            tasks[user_id][task_id] = task
+    started = tasks[1][1]
+    started.state, started.started_at, started.ends_at = IN_PROGRESS, 1e9, 1e9 + 3600
+    log.record(STARTED, 1, started)
+    started.ends_at += 3600
+    log.record(EXTENDED, 1, started)
+    tasks[2][2].state = DONE
+    log.record(FINISHED, 2, tasks[2][2])
+    log.delete(2, 3)
+    del tasks[2][3]
+    # No duration nor deadline yet
+    tasks[2][6] = Task(6, 'draft', None, None, NEW)
+    log.record(ADDED, 2, tasks[2][6])
+    return {user_id: list(user_tasks.values()) for user_id, user_tasks in tasks.items()}
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'events')
+    log = EventLog(path)
+    expected = fill(log)
+    log.sync()
+    log.close()
+    assert snapshot(EventLog(path).load()) == snapshot(expected)
+
+
+def test_compaction_keeps_the_tasks(tmp_path):
+    path = str(tmp_path / 'events')
+    log = EventLog(path)
+    expected = fill(log)
+    log.compact()
+    snapshot_path, old, _ = log.paths()
+    assert os.path.exists(snapshot_path) and not os.path.exists(old)
+    assert snapshot(log.load()) == snapshot(expected)
+
+    # Events after the compaction replay on top of the snapshot
+    log.delete(1, 4)
+    log.compact()
+    log.record(ADDED, 3, Task(7, 'later', 1, 1e9, NEW))
+    log.close()
+    stores = EventLog(path).load()
+    expected[1] = [task for task in expected[1] if task.id != 4]
+    expected[3] = [Task(7, 'later', 1, 1e9, NEW)]
+    assert snapshot(stores) == snapshot(expected)
+
+
+def test_compaction_folds_in_an_interrupted_one(tmp_path):
+    path = str(tmp_path / 'events')
+    log = EventLog(path)
+    log.record(ADDED, 1, Task(1, 'first', 1, 1e9, NEW))
+    log.close()
+    os.replace(path, path + '.old')
+    log = EventLog(path)
+    log.record(ADDED, 1, Task(2, 'second', 1, 1e9, NEW))
+    log.compact()
+    log.close()
+    assert not os.path.exists(path + '.old')
+    assert sorted(task.name for task in load(*log.paths())[1]) == ['first', 'second']
+
+
+def test_recovery_from_a_torn_tail(tmp_path):
+    path = str(tmp_path / 'events')
+    log = EventLog(path)
+    log.record(ADDED, 1, Task(1, 'kept', 1, 1e9, NEW))
+    log.close()
+    with open(path, 'ab') as file:
+        file.write(encode(ADDED, 1, 2, Task(2, 'torn', 1, 1e9, NEW))[:-3])
+    assert [task.name for task in load(path)[1]] == ['kept']
+
+    # Reopening cuts the torn record off, so the next events are read back
+    log = EventLog(path)
+    log.record(ADDED, 1, Task(3, 'after', 1, 1e9, NEW))
+    log.close()
+    assert sorted(task.name for task in load(path)[1]) == ['after', 'kept']
+
+
+def test_deleted_tasks_are_not_loaded(tmp_path):
+    path = str(tmp_path / 'events')
+    log = EventLog(path)
+    log.record(ADDED, 1, Task(1, 'gone', 1, 1e9, NEW))
+    log.delete(1, 1)
+    log.close()
+    assert load(path) == {}
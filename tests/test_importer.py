@@ -0,0 +1,57 @@
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from importer import MAX_TASKS, document_rows, parse_tasks, text_rows
+
+NOW = datetime(2030, 1, 1, 12, 0)
+LATER = str(NOW + timedelta(days=1))
+
+
+def test_valid_rows():
+    tasks, errors = parse_tasks(text_rows('name,duration,deadline\nwrite,2,{}\n\n"a, b", 1 ,{}'.format(LATER, LATER)),
+                                NOW)
+    deadline = (NOW + timedelta(days=1)).timestamp()
+    assert errors == []
+    assert tasks == [('write', 2, deadline), ('a, b', 1, deadline)]
+
+
+@pytest.mark.parametrize('line, error', [
+    ('write,2', 'expected name, duration, deadline'),
+    ('write,2,{},extra'.format(LATER), 'expected name, duration, deadline'),
+    (' ,2,{}'.format(LATER), 'the name is empty'),
+    ('write,0,{}'.format(LATER), 'the duration must be a positive number of hours'),
+    ('write,-1,{}'.format(LATER), 'the duration must be a positive number of hours'),
+    ('write,1.5,{}'.format(LATER), 'the duration must be a positive number of hours'),
+    ('write,2,tomorrow', 'Invalid isoformat string'),
+    ('write,2,{}'.format(NOW - timedelta(minutes=1)), 'the deadline is in the past'),
+    ('write,2,{}+02:00'.format(LATER), 'the deadline must be in local time, without a UTC offset'),
+])
+def test_error_rows(line, error):
+    tasks, errors = parse_tasks(text_rows('ok,1,{}\n{}'.format(LATER, line)), NOW)
+    assert len(tasks) == 1
+    assert len(errors) == 1
+    assert errors[0].startswith('Line 2: ')
+    assert error in errors[0]
+
+
+def test_json_rows():
+    document = json.dumps([{'name': 'write', 'duration': 2, 'deadline': LATER}, ['read', 1, LATER],
+                           {'name': 'no deadline', 'duration': 1}, 'not a task']).encode()
+    tasks, errors = parse_tasks(document_rows(io.BytesIO(document), 'tasks.json'), NOW)
+    assert [name for name, _, _ in tasks] == ['write', 'read']
+    assert errors == ["Line 3: Invalid isoformat string: ''", 'Line 4: expected name, duration, deadline']
+
+
+def test_json_document_must_be_a_list():
+    with pytest.raises(ValueError):
+        list(document_rows(io.BytesIO(b'{"name": "write"}'), 'tasks.json'))
+
+
+def test_too_many_rows():
+    rows = text_rows('\n'.join('task {},1,{}'.format(i, LATER) for i in range(MAX_TASKS + 5)))
+    tasks, errors = parse_tasks(rows, NOW)
+    assert len(tasks) == MAX_TASKS
+    assert errors == ['More than {} tasks, split the import'.format(MAX_TASKS)]
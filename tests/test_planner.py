@@ -0,0 +1,72 @@
+import random
+
+import pytest
+
+from planner import BLOCK, Plan
+
+
+def brute_force_first_late(entries, start):
+    for deadline, task_id, work in sorted(entries):
+        start += work
+        if start > deadline:
+            return task_id, start - deadline
+    return None
+
+
+def check(plan, entries, rng):
+    ordered = sorted(entries)
+    assert len(plan) == len(entries)
+    assert plan.first() == (ordered[0][1] if ordered else None)
+    assert [task_id for task_id, _, _ in plan.schedule(0)] == [task_id for _, task_id, _ in ordered]
+    total = sum(work for _, _, work in entries)
+    for start in [0, total // 2, total] + [rng.uniform(-total, total) for _ in range(5)]:
+        assert plan.first_late(start) == brute_force_first_late(entries, start)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_first_late_matches_brute_force_edf(seed):
+    rng = random.Random(seed)
+    plan = Plan()
+    entries = set()
+    task_ids = iter(range(1, 10 ** 6))
+    # Enough entries for several block splits, deadlines tight enough for some to be late
+    for step in range(10 * BLOCK):
+        if entries and rng.random() < 0.3:
+            entry = rng.choice(sorted(entries))
+            entries.discard(entry)
+            plan.remove(*entry[:2])
+        elif rng.random() < 0.05:
+            batch = {(rng.randrange(1000, 50000), next(task_ids), rng.randrange(1, 100)) for _ in range(BLOCK)}
+            entries |= batch
+            plan.add_many(batch)
+        else:
+            entry = (rng.randrange(1000, 50000), next(task_ids), rng.randrange(1, 100))
+            entries.add(entry)
+            plan.add(*entry)
+        if step % 37 == 0:
+            check(plan, entries, rng)
+    check(plan, entries, rng)
+
+
+def test_remove_everything_and_unknown_entries():
+    plan = Plan()
+    entries = [(deadline, deadline, 10) for deadline in range(3 * BLOCK)]
+    for entry in entries:
+        plan.add(*entry)
+    plan.remove(5, 12345)
+    plan.remove(10 ** 9, 1)
+    assert len(plan) == len(entries)
+    for entry in entries:
+        plan.remove(*entry[:2])
+    assert len(plan) == 0
+    assert plan.first() is None
+    assert plan.first_late(0) is None
+
+
+def test_first_late_reports_how_late():
+    plan = Plan()
+    plan.add(100, 1, 60)
+    plan.add(150, 2, 60)
+    assert plan.first_late(0) is None
+    assert plan.first_late(40) == (2, 10)
+    assert plan.first_late(50) == (1, 10)
@@ -0,0 +1,83 @@
+import pickle
+import random
+
+import pytest
+
+from tasks import DONE, IN_PROGRESS, NEW, STATES, Task, TaskStore, planned
+
+
+def check(store, tasks):
+    """Every index of store agrees with the tasks, which are {task id: task}."""
+    assert len(store) == len(tasks)
+    assert sorted(task.id for task in store) == sorted(tasks)
+    for state in STATES:
+        in_state = [task for task in tasks.values() if task.state == state]
+        assert store.count(state) == len(in_state)
+        assert store.has_state(state) == bool(in_state)
+        with_deadline = sorted((task.deadline, task.id) for task in in_state if task.deadline is not None)
+        assert [(task.deadline, task.id) for task in store.by_deadline(state)] == with_deadline
+        assert store.count_with_deadline(state) == len(with_deadline)
+    by_deadline = sorted((task.deadline, task.id) for task in tasks.values()
+                         if task.state in (NEW, IN_PROGRESS) and task.deadline is not None)
+    page, has_more = store.page(0, 5, NEW, IN_PROGRESS)
+    assert [(task.deadline, task.id) for task in page] == by_deadline[:5]
+    assert has_more == (len(by_deadline) > 5)
+    plan = sorted(filter(None, map(planned, tasks.values())))
+    assert [task.id for task, _, _ in store.schedule(0, len(tasks))] == [task_id for _, task_id, _ in plan]
+    assert [store.number(task) for task in sorted(tasks.values(), key=lambda task: task.id)] == \
+        list(range(1, len(tasks) + 1))
+
+
+def random_task(rng, task_id):
+    deadline = None if rng.random() < 0.1 else rng.randrange(1000, 100000)
+    duration = None if rng.random() < 0.1 else rng.randrange(1, 10)
+    return Task(task_id, 'task {}'.format(task_id), duration, deadline, NEW)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_indexes_stay_consistent(seed):
+    rng = random.Random(seed)
+    store = TaskStore()
+    tasks = {}
+    task_ids = iter(range(1, 10 ** 6))
+    for step in range(2000):
+        action = rng.random()
+        if action < 0.3 or not tasks:
+            task = random_task(rng, next(task_ids))
+            store.add(task)
+            tasks[task.id] = task
+        elif action < 0.35:
+            batch = [random_task(rng, next(task_ids)) for _ in range(rng.randrange(1, 50))]
+            store.add_many(batch)
+            tasks.update((task.id, task) for task in batch)
+        elif action < 0.55:
+            task_id = rng.choice(list(tasks))
+            assert store.remove(task_id) is tasks.pop(task_id)
+        elif action < 0.8:
+            task = tasks[rng.choice(list(tasks))]
+            version = task.version
+            store.set_state(task, rng.choice(STATES))
+            assert task.version == version + 1
+        else:
+            task = tasks[rng.choice(list(tasks))]
+            store.set_deadline(task, rng.randrange(1000, 100000))
+        if step % 97 == 0:
+            check(store, tasks)
+    check(store, tasks)
+    copy = pickle.loads(pickle.dumps(store))
+    check(copy, {task.id: task for task in copy})
+
+
+def test_remove_unknown_task():
+    store = TaskStore()
+    store.add(Task(1, 'write', 1, 1000, NEW))
+    assert store.remove(2) is None
+    assert len(store) == 1
+
+
+def test_next_frog():
+    store = TaskStore()
+    store.add_many([Task(1, 'later', 1, 20000, NEW), Task(2, 'sooner', 1, 10000, NEW), Task(3, 'done', 1, 5000, DONE)])
+    assert store.next_frog().id == 2
+    store.set_state(store.get(1), IN_PROGRESS)
+    assert store.next_frog().id == 1
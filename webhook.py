@@ -0,0 +1,116 @@
+import hmac
+import logging
+import ssl
+
+import tornado.web
+from telegram.error import TelegramError, Unauthorized
+from telegram.ext import Updater
+from telegram.ext.utils.webhookhandler import WebhookAppClass, WebhookHandler, WebhookServer
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class SecretWebhookHandler(WebhookHandler):
+    """Webhook handler that only accepts updates signed with the secret token.
+
+    Updates are refused with 503 while the dispatch queue is full, Telegram retries them later.
+    """
+
+    def initialize(self, bot, update_queue, secret_token=None, max_queue_size=0):
+        super().initialize(bot, update_queue)
+        self.secret_token = secret_token
+        self.max_queue_size = max_queue_size
+
+    def _validate_post(self):
+        super()._validate_post()
+        if self.secret_token is not None:
+            received = self.request.headers.get(SECRET_TOKEN_HEADER, '')
+            if not hmac.compare_digest(received, self.secret_token):
+                raise tornado.web.HTTPError(403)
+        if self.max_queue_size and self.update_queue.qsize() >= self.max_queue_size:
+            raise tornado.web.HTTPError(503)
+
+
+class SecretWebhookApp(WebhookAppClass):
+    """PTB's webhook application with the secret token check and the bound on the dispatch queue."""
+
+    def __init__(self, webhook_path, bot, update_queue, secret_token=None, max_queue_size=0):
+        self.shared_objects = {'bot': bot, 'update_queue': update_queue, 'secret_token': secret_token,
+                               'max_queue_size': max_queue_size}
+        tornado.web.Application.__init__(self, [(r'{}/?'.format(webhook_path), SecretWebhookHandler,
+                                                 self.shared_objects)])
+
+
+class WebhookUpdater(Updater):
+    """Updater whose webhook server checks the secret token and bounds the dispatch queue.
+
+    The server is PTB's tornado one, running on an asyncio event loop in its own thread. TLS, the
+    generated webhook url and the bootstrap retries work as in PTB.
+    """
+
+    def __init__(self, *args, secret_token=None, max_queue_size=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.secret_token = secret_token
+        self.max_queue_size = max_queue_size
+
+    def _start_webhook(self, listen, port, url_path, cert, key, bootstrap_retries, drop_pending_updates,
+                       webhook_url, allowed_updates, ready=None, ip_address=None, max_connections=40):
+        if self.secret_token is None:
+            logger.warning('The webhook has no secret token, anyone who finds its url can post updates to the bot')
+        if not url_path.startswith('/'):
+            url_path = '/' + url_path
+        app = SecretWebhookApp(url_path, self.bot, self.update_queue, self.secret_token, self.max_queue_size)
+
+        # As in PTB, the server only does TLS with both the certificate and the key, else a proxy does it
+        ssl_ctx = None
+        if cert is not None and key is not None:
+            try:
+                ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+                ssl_ctx.load_cert_chain(cert, key)
+            except ssl.SSLError as exc:
+                raise TelegramError('Invalid SSL Certificate') from exc
+        self.httpd = WebhookServer(listen, port, app, ssl_ctx)
+
+        if not webhook_url:
+            webhook_url = self._gen_webhook_url(listen, port, url_path)
+        cert_file = open(cert, 'rb') if cert is not None else None
+        try:
+            self._bootstrap(max_retries=bootstrap_retries, drop_pending_updates=drop_pending_updates,
+                            webhook_url=webhook_url, allowed_updates=allowed_updates, cert=cert_file,
+                            ip_address=ip_address, max_connections=max_connections)
+        finally:
+            if cert_file is not None:
+                cert_file.close()
+
+        self.httpd.serve_forever(ready=ready)
+
+    def _bootstrap(self, max_retries, drop_pending_updates, webhook_url, allowed_updates, cert=None,
+                   bootstrap_interval=5, ip_address=None, max_connections=40):
+        if not self.secret_token or not webhook_url:
+            super()._bootstrap(max_retries, drop_pending_updates, webhook_url, allowed_updates, cert=cert,
+                               bootstrap_interval=bootstrap_interval, ip_address=ip_address,
+                               max_connections=max_connections)
+            return
+        # PTB sets the webhook without the secret token, which Bot.set_webhook predates: it only drops
+        # the pending updates, the webhook is set here with the same retries
+        if drop_pending_updates:
+            super()._bootstrap(max_retries, drop_pending_updates, None, allowed_updates,
+                               bootstrap_interval=bootstrap_interval)
+        retries = [0]
+
+        def set_webhook():
+            self.bot.set_webhook(webhook_url, certificate=cert, allowed_updates=allowed_updates,
+                                 ip_address=ip_address, drop_pending_updates=drop_pending_updates,
+                                 max_connections=max_connections, api_kwargs={'secret_token': self.secret_token})
+            return False
+
+        def on_error(exc):
+            if isinstance(exc, Unauthorized) or 0 <= max_retries <= retries[0]:
+                logger.error('Failed bootstrap phase after %s retries (%s)', retries[0], exc)
+                raise exc
+            retries[0] += 1
+            logger.warning('Failed bootstrap phase; try=%s max_retries=%s', retries[0], max_retries)
+
+        self._network_loop_retry(set_webhook, on_error, 'bootstrap set webhook', bootstrap_interval)